@@ -1,3 +1,4 @@
 from sfs.sfs import SFSContainer
+from sfs.builder import SFSBuilder
 
-__all__ = ['SFSContainer']
+__all__ = ['SFSContainer', 'SFSBuilder']
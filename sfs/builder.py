@@ -0,0 +1,163 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import struct
+from typing import BinaryIO, Iterator
+
+from sfs.cipher import ChunkCipher
+from sfs.structs import (Header, DirectoryTree, FileChunk, FileHeader,
+                         HEADER_SIZE, CHUNKS_OFFSET, CHUNK_HEADER_SIZE,
+                         valid_chunk_size)
+from sfs.utils import (make_chunks, aacs_deflate, free_map_capacity,
+                       make_free_map, make_map_chunk)
+
+
+# Header values found in the STC files written by Cablabel S3
+HEADER_TEMPLATE = struct.pack(
+    '<8s272s8sIIIIIIIIIII32s', b'AAMVHFSS',
+    b'\xfe\xff\xff\xff\xff\xff\xff\x7f' + b'\x00' * 264, b'AASFSSGN',
+    1086328998, 1086324736, 4096, 8, 1, 1, 1, 2, 4, 0, 0, b'\x00' * 32)
+
+Job = tuple[FileHeader, bytes, None | bytes, None | int, int]
+
+
+def _encode_member(job: Job) -> tuple[int, list[bytes]]:
+    file, data, password, compression_level, chunk_size = job
+    key = None if password is None else file.decrypt_key(password)
+    if compression_level is not None:
+        data = aacs_deflate(data, compression_level)
+    return len(data), make_chunks(data, chunk_size, key)
+
+
+class SFSBuilder:
+    def __init__(self, chunk_size: int = 4096,
+                 archive_password: None | bytes = None) -> None:
+        if not valid_chunk_size(chunk_size):
+            raise NotImplementedError(f'Unsupported chunk size {chunk_size}')
+        self.chunk_size = chunk_size
+        self.archive_password = archive_password
+        self.entries: list[FileHeader] = []
+        self._paths: dict[str, int] = {}
+        self._jobs: dict[int, Job] = {}
+
+    def _add_entry(self, path: str, directory: bool) -> int:
+        if path in self._paths:
+            raise FileExistsError(path)
+        dirname, _, name = path.rpartition('/')
+        parent = self.add_directory(dirname) if dirname else -1
+        self.entries.append(FileHeader.new(name, parent, directory))
+        self._paths[path] = len(self.entries) - 1
+        return self._paths[path]
+
+    def add_directory(self, path: str) -> int:
+        if path in self._paths:
+            if self.entries[self._paths[path]].ftype != 16:
+                raise NotADirectoryError(path)
+            return self._paths[path]
+        return self._add_entry(path, True)
+
+    def add_file(self, path: str, data: bytes,
+                 password: None | bytes = None,
+                 compression_level: None | int = 1) -> FileHeader:
+        index = self._add_entry(path, False)
+        file = self.entries[index]
+        if password is not None:
+            file.generate_key(password)
+        self._jobs[index] = (file, data, password, compression_level,
+                             self.chunk_size)
+        return file
+
+    def _encode(self, workers: None | int
+                ) -> Iterator[tuple[int, tuple[int, list[bytes]]]]:
+        indexes = list(self._jobs)
+        jobs = [self._jobs[i] for i in indexes]
+        if workers == 1 or len(jobs) < 2:
+            yield from zip(indexes, map(_encode_member, jobs))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from zip(indexes, executor.map(_encode_member, jobs))
+
+    def write(self, fd: BinaryIO, workers: None | int = None) -> None:
+        # Everything is laid out contiguously: header, free map, directory
+        # tree, then the FileChunk index and data chunks of each member
+        cs = self.chunk_size
+        tree_capacity = DirectoryTree.capacity(cs)
+        fc_capacity = FileChunk.capacity(cs)
+        n_tree = max(1, -(-len(self.entries) // tree_capacity))
+        next_chunk = 4 + n_tree
+
+        members: list[tuple[list[int], list[bytes]]] = []
+        for index, (size, chunks) in self._encode(workers):
+            file = self.entries[index]
+            file.size = size
+            if not chunks:
+                continue
+            n_fc = -(-len(chunks) // fc_capacity)
+            file.offset = next_chunk
+            fcs = list(range(next_chunk, next_chunk + n_fc))
+            next_chunk += n_fc
+            members.append((fcs, chunks))
+            next_chunk += len(chunks)
+
+        hdr = Header(HEADER_TEMPLATE)
+        hdr.chunk_size = cs
+        hdr.tree_offset = 4
+        hdr.n_entr = len(self.entries)
+        hdr.n_chunks = next_chunk
+        cipher = None
+        if self.archive_password is not None:
+            hdr.generate_key(self.archive_password)
+            cipher = ChunkCipher(hdr.decrypt_key(self.archive_password), 0)
+        fd.write(hdr.serialize())
+        fd.write(b'\x00' * (CHUNKS_OFFSET + cs - HEADER_SIZE))
+
+        def put(chunks: list[bytes]) -> None:
+            if cipher is not None:
+                chunks = cipher.encrypt_many(chunks)
+            for chunk in chunks:
+                fd.write(chunk)
+
+        # a large archive only has its first chunks in the free map
+        n_mapped = min(next_chunk, free_map_capacity(cs))
+        put([make_map_chunk(kind, body) for kind, body in
+             zip([4, 2], make_free_map(set(), n_mapped, cs))])
+        put([make_map_chunk(3, b'\x00' * (cs - CHUNK_HEADER_SIZE))])
+
+        for i in range(n_tree):
+            dt = DirectoryTree(b'\x00' * cs, 0)
+            dt.next_chunk = 4 + min(i + 1, n_tree - 1)
+            dt.c = 1
+            dt.files = self.entries[i * tree_capacity:(i + 1) * tree_capacity]
+            put([dt.serialize(cs)])
+
+        for fcs, chunks in members:
+            dchunks = list(range(fcs[-1] + 1, fcs[-1] + 1 + len(chunks)))
+            for i, fc_off in enumerate(fcs):
+                fc = FileChunk.empty(cs)
+                fc.dchunks = dchunks[i * fc_capacity:(i + 1) * fc_capacity]
+                if i + 1 < len(fcs):
+                    fc.next_chunk = fcs[i + 1]
+                put([fc.serialize(cs)])
+            put(chunks)
@@ -0,0 +1,126 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Caches of decoded member contents, bounded in bytes and evicting the least
+# recently used. The process-wide member cache is off until
+# enable_member_cache is called; read_file and read_many then look members
+# up by a fingerprint of their raw chunks, key and password before any
+# decryption, so a member embedded in many archives is decoded once, and a
+# rewritten member or another password never hits.
+
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+import hashlib
+import struct
+import threading
+from typing import Generic, Hashable, Iterable, TypeVar
+
+from sfs.structs import CHUNK_HEADER_SIZE
+
+
+K = TypeVar('K', bound=Hashable)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+class LRUCache(Generic[K]):
+    def __init__(self, max_bytes: int = 64 << 20) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._members: OrderedDict[K, bytes] = OrderedDict()
+        self._stats = CacheStats()
+
+    def get(self, key: K) -> None | bytes:
+        with self._lock:
+            data = self._members.get(key)
+            if data is None:
+                self._stats.misses += 1
+                return None
+            self._stats.hits += 1
+            self._members.move_to_end(key)
+            return data
+
+    def put(self, key: K, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._members.pop(key, None)
+            if old is not None:
+                self._stats.bytes -= len(old)
+            self._members[key] = data
+            self._stats.bytes += len(data)
+            while self._stats.bytes > self.max_bytes:
+                _, evicted = self._members.popitem(last=False)
+                self._stats.bytes -= len(evicted)
+                self._stats.evictions += 1
+            self._stats.entries = len(self._members)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return replace(self._stats)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._members.clear()
+            self._stats = CacheStats()
+
+
+def member_fingerprint(chunks: Iterable[bytes], key: bytes,
+                       password: None | bytes, size: int) -> bytes:
+    # Only the flags and body of each chunk count, the rest of the chunk
+    # header varies between archives holding the same member
+    h = hashlib.blake2b(digest_size=32)
+    pw = b'' if password is None else password
+    h.update(struct.pack('<Qq32s', size, -1 if password is None else len(pw),
+                         key) + pw)
+    for chunk in chunks:
+        view = memoryview(chunk)
+        h.update(view[8:12])
+        h.update(view[CHUNK_HEADER_SIZE:])
+    return h.digest()
+
+
+_member_cache: None | LRUCache[bytes] = None
+
+
+def enable_member_cache(max_bytes: int = 64 << 20) -> LRUCache[bytes]:
+    global _member_cache
+    _member_cache = LRUCache(max_bytes)
+    return _member_cache
+
+
+def disable_member_cache() -> None:
+    global _member_cache
+    _member_cache = None
+
+
+def member_cache() -> None | LRUCache[bytes]:
+    return _member_cache
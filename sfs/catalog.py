@@ -0,0 +1,107 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Inventory of many archives. Each archive is read by a worker process,
+# which only looks at the header, the directory tree and, for the
+# fragmentation figures, the FileChunk chains: member data is never read.
+# Records are yielded as the archives are done.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+import os
+from typing import Iterator
+
+from sfs.sfs import SFSContainer
+from sfs.structs import CHUNK_HEADER_SIZE
+
+ARCHIVE_SUFFIXES = ('.stc', '.sfs')
+
+
+@dataclass(slots=True)
+class CatalogRecord:
+    archive: str
+    path: str
+    size: int = 0
+    ftype: int = 0
+    times: tuple[float, float, float] = (0.0, 0.0, 0.0)
+    encrypted: bool = False
+    chunks: int = 0
+    # runs of consecutive data chunks, None when not looked up
+    fragments: None | int = None
+    # set on a single record for an archive that could not be read
+    error: None | str = None
+
+
+def _fragments(dchunks: list[int]) -> int:
+    return sum(1 for i, c in enumerate(dchunks)
+               if i == 0 or c != dchunks[i - 1] + 1)
+
+
+def scan_archive(archive: str, password: None | bytes = None,
+                 fragmentation: bool = True) -> list[CatalogRecord]:
+    try:
+        with open(archive, 'rb') as fd:
+            sfs = SFSContainer(fd, password)
+            body = sfs._hdr.chunk_size - CHUNK_HEADER_SIZE
+            records = []
+            for path, f in sfs.walk():
+                record = CatalogRecord(archive, path, f.size, f.ftype,
+                                       f.times, f.encrypted)
+                if fragmentation:
+                    dchunks = sfs._get_data_chunk_indexes(f)
+                    record.chunks = len(dchunks)
+                    record.fragments = _fragments(dchunks)
+                elif f.offset != -1:
+                    record.chunks = -(-f.size // body)
+                records.append(record)
+            return records
+    except (OSError, ValueError, AssertionError, NotImplementedError) as e:
+        return [CatalogRecord(archive, '', error=repr(e))]
+
+
+def find_archives(root: str,
+                  suffixes: tuple[str, ...] = ARCHIVE_SUFFIXES
+                  ) -> Iterator[str]:
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(suffixes):
+                yield os.path.join(dirpath, name)
+
+
+def scan(root: str, password: None | bytes = None,
+         fragmentation: bool = True, workers: None | int = None,
+         suffixes: tuple[str, ...] = ARCHIVE_SUFFIXES
+         ) -> Iterator[CatalogRecord]:
+    archives = find_archives(root, suffixes)
+    if workers == 1:
+        for archive in archives:
+            yield from scan_archive(archive, password, fragmentation)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scan_archive, archive, password,
+                                   fragmentation)
+                   for archive in archives]
+        for future in as_completed(futures):
+            yield from future.result()
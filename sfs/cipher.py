@@ -0,0 +1,121 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Whole-archive encryption. When the header holds a key, every chunk after
+# the header is encrypted with the archive key, each one starting its own
+# chain like file data chunks do. Chunks are then decrypted independently:
+# one at a time as they are read, in a process pool for batches, and the
+# plaintext of the most recently used ones is kept.
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import threading
+
+from sfs.wrongaes import sfs_decrypt, sfs_encrypt
+
+try:
+    from sfs.npaes import sfs_encrypt_chunks
+except ImportError:
+    sfs_encrypt_chunks = None  # type: ignore[assignment]
+
+
+def _decrypt(job: tuple[bytes, bytes]) -> bytes:
+    data, key = job
+    buf = bytearray(data)
+    sfs_decrypt(buf, key)
+    return bytes(buf)
+
+
+class ChunkCipher:
+    def __init__(self, key: bytes, cache_size: int = 256) -> None:
+        self.key = key
+        self.cache_size = cache_size
+        # chunk index -> (ciphertext, plaintext)
+        self._cache: OrderedDict[int, tuple[bytes, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, c: int, ciphertext: bytes, plaintext: bytes) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[c] = ciphertext, plaintext
+            self._cache.move_to_end(c)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cached(self, c: int, ciphertext: bytes) -> None | bytes:
+        # the ciphertext is compared so that writes made through another
+        # handle are never answered from the cache
+        with self._lock:
+            entry = self._cache.get(c)
+            if entry is None or entry[0] != ciphertext:
+                return None
+            self._cache.move_to_end(c)
+            return entry[1]
+
+    def decrypt(self, c: int, data: bytes) -> bytes:
+        plaintext = self._cached(c, data)
+        if plaintext is None:
+            plaintext = _decrypt((data, self.key))
+            self._remember(c, data, plaintext)
+        return plaintext
+
+    def decrypt_many(self, chunks: dict[int, bytes],
+                     workers: None | int = None) -> dict[int, bytes]:
+        result = {}
+        missing = []
+        for c, data in chunks.items():
+            plaintext = self._cached(c, data)
+            if plaintext is None:
+                missing.append(c)
+            else:
+                result[c] = plaintext
+        jobs = [(chunks[c], self.key) for c in missing]
+        if workers == 1 or len(jobs) < 2:
+            plaintexts = list(map(_decrypt, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                plaintexts = list(executor.map(_decrypt, jobs))
+        for c, plaintext in zip(missing, plaintexts):
+            self._remember(c, chunks[c], plaintext)
+            result[c] = plaintext
+        return result
+
+    def encrypt(self, c: int, data: bytes) -> bytes:
+        buf = bytearray(data)
+        sfs_encrypt(buf, self.key)
+        ciphertext = bytes(buf)
+        self._remember(c, ciphertext, data)
+        return ciphertext
+
+    def encrypt_many(self, chunks: list[bytes]) -> list[bytes]:
+        # for chunks that are written once, nothing is cached
+        if sfs_encrypt_chunks is None or len(chunks) < 2:
+            result = []
+            for data in chunks:
+                buf = bytearray(data)
+                sfs_encrypt(buf, self.key)
+                result.append(bytes(buf))
+            return result
+        return sfs_encrypt_chunks(chunks, self.key)
@@ -0,0 +1,319 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+import json
+import os
+import struct
+import sys
+import time
+from typing import Callable, Iterator
+import zlib
+
+from sfs.builder import SFSBuilder
+from sfs.catalog import find_archives, scan_archive
+from sfs.sfs import SFSContainer
+
+
+# Each command runs on one archive and returns what to print and how many
+# bytes of member data it processed, and whether it succeeded
+Result = tuple[bytes, int, bool]
+
+
+def _password(args: argparse.Namespace) -> None | bytes:
+    if args.password_file is not None:
+        with open(args.password_file, 'rb') as fd:
+            return fd.read().rstrip(b'\r\n')
+    value = os.environ.get(args.password_env)
+    return None if value is None else value.encode()
+
+
+def _read(sfs: SFSContainer, path: str, args: argparse.Namespace) -> bytes:
+    f = sfs.find_file(path)
+    return sfs.read_file(f, args.password if f.encrypted else None)
+
+
+def cmd_ls(archive: str, args: argparse.Namespace) -> Result:
+    lines = [f'{archive}:']
+    with open(archive, 'rb') as fd:
+        sfs = SFSContainer(fd, args.password)
+        for path, f in sfs.walk():
+            kind = 'd' if f.ftype & 16 else 'e' if f.encrypted else '-'
+            lines.append(f'{kind} {f.size:10d} {path}')
+    return ('\n'.join(lines) + '\n').encode(), 0, True
+
+
+def cmd_cat(archive: str, args: argparse.Namespace) -> Result:
+    with open(archive, 'rb') as fd:
+        data = _read(SFSContainer(fd, args.password), args.member, args)
+    return data, len(data), True
+
+
+def _extract_target(outdir: str, path: str) -> None | str:
+    # Where a member is extracted, None when its name would leave outdir:
+    # absolute names, empty, '.' or '..' components and links out of it
+    parts = path.split('/')
+    if any(p in ('', '.', '..') or os.sep in p or
+           (os.altsep is not None and os.altsep in p) or
+           os.path.splitdrive(p)[0] for p in parts):
+        return None
+    target = os.path.join(outdir, *parts)
+    root = os.path.realpath(outdir)
+    if os.path.commonpath([root, os.path.realpath(target)]) != root:
+        return None
+    return target
+
+
+def cmd_extract(archive: str, args: argparse.Namespace) -> Result:
+    name = os.path.splitext(os.path.basename(archive))[0]
+    outdir = os.path.join(args.output, name)
+    total = 0
+    errors = []
+    with open(archive, 'rb') as fd:
+        sfs = SFSContainer(fd, args.password)
+        for path, f in sfs.walk():
+            target = _extract_target(outdir, path)
+            if target is None:
+                errors.append(f'{archive}: error: unsafe member name '
+                              f'{path!r}\n')
+                continue
+            if f.ftype & 16:
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            data = sfs.read_file(f, args.password if f.encrypted else None)
+            with open(target, 'wb') as out:
+                out.write(data)
+            total += len(data)
+    lines = ''.join(errors) + f'{archive}: extracted to {outdir}\n'
+    return lines.encode(), total, not errors
+
+
+def cmd_replace(archive: str, args: argparse.Namespace) -> Result:
+    with open(args.input, 'rb') as fd:
+        data = fd.read()
+    with open(archive, 'rb+') as fd:
+        sfs = SFSContainer(fd, args.password)
+        f = sfs.find_file(args.member)
+        sfs.write_file(f, data, args.password if f.encrypted else None,
+                       None if args.level < 0 else args.level,
+                       adaptive=args.adaptive,
+                       differential=args.differential)
+    return f'{archive}: replaced {args.member}\n'.encode(), len(data), True
+
+
+def cmd_pack(directory: str, args: argparse.Namespace) -> Result:
+    directory = directory.rstrip('/' + os.sep)
+    builder = SFSBuilder(
+        archive_password=args.password if args.encrypt_archive else None)
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        rel = os.path.relpath(root, directory).replace(os.sep, '/')
+        prefix = '' if rel == '.' else rel + '/'
+        if prefix:
+            builder.add_directory(rel)
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as fd:
+                data = fd.read()
+            builder.add_file(prefix + name, data, args.password,
+                             None if args.level < 0 else args.level)
+            total += len(data)
+    archive = directory + args.suffix
+    with open(archive, 'wb') as fd:
+        builder.write(fd, workers=1)
+    return f'{archive}: packed {directory}\n'.encode(), total, True
+
+
+def cmd_sync(archive: str, args: argparse.Namespace) -> Result:
+    with open(archive, 'rb+') as fd:
+        result = SFSContainer(fd, args.password).sync(
+            args.source, args.password,
+            None if args.level < 0 else args.level, args.checksum,
+            not args.keep)
+    return (f'{archive}: {len(result.added)} added, '
+            f'{len(result.replaced)} replaced, '
+            f'{len(result.deleted)} deleted, '
+            f'{len(result.touched)} touched, '
+            f'{result.unchanged} unchanged\n').encode(), 0, True
+
+
+def cmd_truncate(archive: str, args: argparse.Namespace) -> Result:
+    with open(archive, 'rb+') as fd:
+        before = os.fstat(fd.fileno()).st_size
+        SFSContainer(fd, args.password).truncate()
+        after = os.fstat(fd.fileno()).st_size
+    return f'{archive}: {before} -> {after} bytes\n'.encode(), 0, True
+
+
+def cmd_verify(archive: str, args: argparse.Namespace) -> Result:
+    # members are decoded in this process, archives already run in parallel
+    with open(archive, 'rb') as fd:
+        sfs = SFSContainer(fd, args.password)
+        report = sfs.verify(args.password, decode=True, workers=1)
+    lines = [f'{archive}: FAIL {e}' for e in report.errors]
+    lines += [f'{archive}: FAIL {path}: {e}'
+              for path, e in report.bad_members.items()]
+    if report.leaked:
+        lines.append(f'{archive}: {len(report.leaked)} leaked chunks')
+    if report.ok:
+        lines.append(f'{archive}: OK')
+    return ('\n'.join(lines) + '\n').encode(), 0, report.ok
+
+
+def cmd_catalog(archive: str, args: argparse.Namespace) -> Result:
+    records = scan_archive(archive, args.password, not args.fast)
+    lines = [json.dumps(dataclasses.asdict(r)) for r in records]
+    return ('\n'.join(lines) + '\n').encode(), 0, records[0].error is None
+
+
+def cmd_bench(archive: str, args: argparse.Namespace) -> Result:
+    total = 0
+    t0 = time.perf_counter()
+    with open(archive, 'rb') as fd:
+        sfs = SFSContainer(fd, args.password)
+        stats = sfs.enable_stats()
+        for _, f in sfs.walk():
+            total += len(sfs.read_file(
+                f, args.password if f.encrypted else None))
+    elapsed = time.perf_counter() - t0
+    report = {'archive': archive, 'bytes': total, 'seconds': elapsed,
+              'stages': stats.snapshot()}
+    return (json.dumps(report) + '\n').encode(), total, True
+
+
+COMMANDS: dict[str, Callable[[str, argparse.Namespace], Result]] = {
+    'ls': cmd_ls,
+    'cat': cmd_cat,
+    'extract': cmd_extract,
+    'replace': cmd_replace,
+    'pack': cmd_pack,
+    'sync': cmd_sync,
+    'truncate': cmd_truncate,
+    'verify': cmd_verify,
+    'bench': cmd_bench,
+    'catalog': cmd_catalog,
+}
+
+
+def _run(job: tuple[str, argparse.Namespace]) -> Result:
+    path, args = job
+    try:
+        return COMMANDS[args.command](path, args)
+    except (OSError, AssertionError, ValueError, NotImplementedError,
+            struct.error, zlib.error) as e:
+        return f'{path}: error: {e!r}\n'.encode(), 0, False
+
+
+def _results(args: argparse.Namespace) -> Iterator[Result]:
+    jobs = [(path, args) for path in args.archives]
+    if args.jobs == 1 or len(jobs) < 2:
+        yield from map(_run, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=args.jobs or None) as executor:
+        yield from executor.map(_run, jobs)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='sfs', description='Work on Single File System archives')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes, 0 for one per CPU')
+    parser.add_argument('--password-env', default='SFS_PASSWORD',
+                        help='environment variable holding the password')
+    parser.add_argument('--password-file',
+                        help='file holding the password')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not report throughput')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('ls', help='list members')
+    p = sub.add_parser('cat', help='write a member to stdout')
+    p.add_argument('member')
+    p = sub.add_parser('extract', help='extract all members')
+    p.add_argument('-o', '--output', default='.')
+    p = sub.add_parser('replace', help='replace a member')
+    p.add_argument('member')
+    p.add_argument('input', help='file with the new contents')
+    p.add_argument('-l', '--level', type=int, default=1,
+                   help='compression level, -1 to store without AACS')
+    p.add_argument('--adaptive', action='store_true')
+    p.add_argument('--differential', action='store_true',
+                   help='only write the chunks that changed')
+    p = sub.add_parser('pack', help='create archives from directories')
+    p.add_argument('-l', '--level', type=int, default=1,
+                   help='compression level, -1 to store without AACS')
+    p.add_argument('--suffix', default='.sfs')
+    p.add_argument('--encrypt-archive', action='store_true',
+                   help='also encrypt the whole archive with the password')
+    p = sub.add_parser('sync', help='mirror a directory into archives')
+    p.add_argument('source')
+    p.add_argument('-l', '--level', type=int, default=1,
+                   help='compression level, -1 to store without AACS')
+    p.add_argument('--checksum', action='store_true',
+                   help='compare contents when the times differ')
+    p.add_argument('--keep', action='store_true',
+                   help='do not delete members missing from the source')
+    sub.add_parser('truncate', help='drop free chunks at the end')
+    sub.add_parser('verify', help='decode every member')
+    sub.add_parser('bench', help='time decoding every member')
+    p = sub.add_parser('catalog',
+                       help='list members of archives and directories of '
+                       'archives as JSON lines')
+    p.add_argument('--fast', action='store_true',
+                   help='skip the FileChunk chains, no fragmentation')
+    for name, p in sub.choices.items():
+        metavar = {'pack': 'directory', 'catalog': 'path'}.get(name,
+                                                               'archive')
+        p.add_argument('archives', nargs='+', metavar=metavar)
+    return parser
+
+
+def main(argv: None | list[str] = None) -> int:
+    args = make_parser().parse_args(argv)
+    args.password = _password(args)
+    if args.command == 'catalog':
+        args.archives = [archive for path in args.archives
+                         for archive in (find_archives(path)
+                                         if os.path.isdir(path) else [path])]
+    ok = True
+    total = 0
+    t0 = time.perf_counter()
+    for output, nbytes, success in _results(args):
+        sys.stdout.buffer.write(output)
+        sys.stdout.buffer.flush()
+        total += nbytes
+        ok = ok and success
+    elapsed = time.perf_counter() - t0
+    if not args.quiet:
+        rate = total / elapsed / 1e6 if elapsed > 0 else 0.0
+        print(f'{len(args.archives)} archives, {total} bytes in '
+              f'{elapsed:.3f}s ({rate:.2f} MB/s)', file=sys.stderr)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
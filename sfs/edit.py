@@ -0,0 +1,144 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Batched metadata edits. Renames, moves and time updates are collected by
+# path, checked together against the tree as it will be afterwards, and
+# applied in one pass over the directory tree, so every tree chunk holding
+# an edited entry is serialized and written once however many of its
+# entries change.
+
+from collections import Counter
+from types import TracebackType
+from typing import TYPE_CHECKING
+
+from sfs.structs import entry_paths
+
+if TYPE_CHECKING:
+    from sfs.sfs import SFSContainer
+
+
+Times = tuple[None | float, None | float, None | float]
+
+
+class MetadataBatch:
+    def __init__(self, sfs: 'SFSContainer') -> None:
+        self._sfs = sfs
+        self._names: dict[str, str] = {}
+        self._parents: dict[str, str] = {}
+        self._times: dict[str, Times] = {}
+
+    def __enter__(self) -> 'MetadataBatch':
+        return self
+
+    def __exit__(self, exc_type: None | type[BaseException],
+                 exc: None | BaseException,
+                 tb: None | TracebackType) -> None:
+        if exc_type is None:
+            self.commit()
+
+    def rename(self, path: str, name: str) -> None:
+        if not name or '/' in name or not name.isascii() or len(name) >= 288:
+            raise ValueError(f'Bad member name {name!r}')
+        self._names[path] = name
+
+    def move(self, path: str, directory: str) -> None:
+        # directory is the path of the new parent, '' for the top level
+        self._parents[path] = directory
+
+    def set_times(self, path: str, created: None | float = None,
+                  accessed: None | float = None,
+                  written: None | float = None) -> None:
+        # FILETIME values as from structs.filetime, None keeps the old one
+        old = self._times.get(path, (None, None, None))
+        self._times[path] = (old[0] if created is None else created,
+                             old[1] if accessed is None else accessed,
+                             old[2] if written is None else written)
+
+    def commit(self) -> int:
+        # Paths refer to the tree before the batch. Returns the number of
+        # tree chunks written.
+        sfs = self._sfs
+        with sfs._alloc_lock:
+            tree = list(sfs.enumerate_tree())
+            entries = []
+            owners = []
+            for pos, (_, dt) in enumerate(tree):
+                entries += dt.files
+                owners += [pos] * len(dt.files)
+            index = {path: i for i, path in enumerate(entry_paths(entries))}
+
+            def lookup(path: str) -> int:
+                if path not in index:
+                    raise FileNotFoundError(path)
+                return index[path]
+
+            names = {lookup(p): n for p, n in self._names.items()}
+            parents = {lookup(p): -1 if d == '' else lookup(d)
+                       for p, d in self._parents.items()}
+            times = {lookup(p): t for p, t in self._times.items()}
+
+            def parent(i: int) -> int:
+                return parents.get(i, entries[i].parent)
+
+            def name(i: int) -> str:
+                return names.get(i, entries[i].filename)
+
+            for i, p in parents.items():
+                if p != -1 and not entries[p].ftype & 16:
+                    raise NotADirectoryError(entry_paths(entries)[p])
+                seen = set()
+                while p != -1 and p not in seen:
+                    if p == i:
+                        raise ValueError(
+                            f'Cannot move {entries[i].filename} into itself')
+                    seen.add(p)
+                    p = parent(p)
+            siblings = Counter((parent(i), name(i))
+                               for i in range(len(entries)))
+            for i in set(names) | set(parents):
+                if siblings[parent(i), name(i)] > 1:
+                    raise FileExistsError(name(i))
+
+            dirty = set()
+            for i in set(names) | set(parents) | set(times):
+                f = entries[i]
+                t = times.get(i, (None, None, None))
+                new_times = (f.times[0] if t[0] is None else t[0],
+                             f.times[1] if t[1] is None else t[1],
+                             f.times[2] if t[2] is None else t[2])
+                new = (name(i), parent(i), new_times)
+                if (f.filename, f.parent, f.times) == new:
+                    continue
+                f.filename = name(i)
+                f.parent = parent(i)
+                f.times = new_times
+                dirty.add(owners[i])
+            cs = sfs._hdr.chunk_size
+            for pos in sorted(dirty):
+                chunk_idx, dt = tree[pos]
+                sfs._put_chunk(chunk_idx, dt.serialize(cs))
+        self._names.clear()
+        self._parents.clear()
+        self._times.clear()
+        return len(dirty)
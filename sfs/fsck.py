@@ -0,0 +1,216 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Integrity check of a whole archive. The file is mapped and its chunks are
+# checksummed in one sequential pass, then the metadata chains are walked
+# on the mapped pages to find cycles, cross-links and leaked chunks.
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import mmap
+import os
+import struct
+from typing import BinaryIO
+
+from sfs.cipher import ChunkCipher
+from sfs.structs import (Header, DirectoryTree, FileChunk, FileHeader,
+                         HEADER_SIZE, CHUNKS_OFFSET, CHUNK_HEADER_SIZE,
+                         entry_paths, valid_chunk_size)
+from sfs.wrongaes import checkxor
+
+
+@dataclass
+class VerifyReport:
+    n_chunks: int = 0
+    n_entries: int = 0
+    errors: list[str] = field(default_factory=list)
+    bad_xor: list[int] = field(default_factory=list)
+    cross_linked: list[int] = field(default_factory=list)
+    leaked: list[int] = field(default_factory=list)
+    free_but_used: list[int] = field(default_factory=list)
+    bad_members: dict[str, str] = field(default_factory=dict)
+    members_checked: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not (self.errors or self.bad_xor or self.cross_linked or
+                    self.free_but_used or self.bad_members)
+
+
+def _decode_member(job: tuple[str, bytes, None | bytes]) -> None | str:
+    from sfs.sfs import SFSContainer
+    path, header, password = job
+    file = FileHeader(header)
+    with open(path, 'rb') as fd:
+        try:
+            SFSContainer(fd, password).read_file(
+                file, password if file.encrypted else None)
+        except Exception as e:
+            # whatever breaks decoding, a corrupt deflate stream raises
+            # zlib.error, goes in the report
+            return repr(e)
+    return None
+
+
+def verify_archive(fd: BinaryIO, password: None | bytes = None,
+                   decode: bool = False,
+                   workers: None | int = None) -> VerifyReport:
+    report = VerifyReport()
+    size = os.fstat(fd.fileno()).st_size
+    if size < HEADER_SIZE:
+        report.errors.append('File too short for an SFS header')
+        return report
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            hdr = Header(mm[:HEADER_SIZE])
+        except AssertionError:
+            report.errors.append('Bad SFS header magic')
+            return report
+        cs = hdr.chunk_size
+        if not valid_chunk_size(cs):
+            report.errors.append(f'Bad chunk size {cs}')
+            return report
+        n = report.n_chunks = (size - CHUNKS_OFFSET) // cs
+        if (size - CHUNKS_OFFSET) % cs:
+            report.errors.append('File size is not a whole number of chunks')
+        if hdr.n_chunks < n:
+            report.errors.append(f'Header counts {hdr.n_chunks} chunks, '
+                                 f'file has {n}')
+
+        plain: dict[int, bytes] = {}
+        if hdr.encrypted:
+            if password is None:
+                report.errors.append('The archive is encrypted, '
+                                     'a password is needed')
+                return report
+            cipher = ChunkCipher(hdr.decrypt_key(password), cache_size=0)
+            plain = cipher.decrypt_many(
+                {c: mm[hdr.chunk_position(c):hdr.chunk_position(c + 1)]
+                 for c in range(1, n)}, workers)
+
+        def chunk(c: int) -> bytes:
+            if c in plain:
+                return plain[c]
+            return mm[hdr.chunk_position(c):hdr.chunk_position(c + 1)]
+
+        # the one sequential pass over the file
+        xor_ok = bytearray(n)
+        for c in range(1, n):
+            data = chunk(c)
+            stored, = struct.unpack_from('<I', data, 4)
+            xor_ok[c] = checkxor(data[CHUNK_HEADER_SIZE:]) == stored
+
+        owner = {0: 'header', 1: 'free map', 2: 'free map', 3: 'reserved'}
+
+        def claim(c: int, what: str) -> bool:
+            if not 0 < c < n:
+                report.errors.append(f'{what} uses chunk {c} out of file')
+                return False
+            if c in owner:
+                report.cross_linked.append(c)
+                kind = 'cycle' if owner[c] == what else 'cross-link'
+                report.errors.append(
+                    f'{kind}: {what} and {owner[c]} use chunk {c}')
+                return False
+            owner[c] = what
+            return True
+
+        def check_xor(c: int, what: str) -> bool:
+            if not xor_ok[c]:
+                report.bad_xor.append(c)
+                report.errors.append(f'{what} chunk {c} fails checkxor')
+            return bool(xor_ok[c])
+
+        entries: list[FileHeader] = []
+        nco = hdr.tree_offset
+        rem_entries = hdr.n_entr
+        while claim(nco, 'directory tree'):
+            if not check_xor(nco, 'directory tree'):
+                break
+            try:
+                dt = DirectoryTree(chunk(nco), rem_entries)
+            except AssertionError as e:
+                report.errors.append(f'directory tree chunk {nco}: {e!r}')
+                break
+            entries.extend(dt.files)
+            rem_entries -= len(dt.files)
+            if rem_entries == 0 or nco == dt.next_chunk or dt.next_chunk <= 0:
+                break
+            nco = dt.next_chunk
+        report.n_entries = len(entries)
+        if rem_entries:
+            report.errors.append(f'Header counts {hdr.n_entr} entries, '
+                                 f'directory tree has {len(entries)}')
+
+        paths = entry_paths(entries)
+        members = []
+        for path, f in zip(paths, entries):
+            if f.parent != -1 and not (
+                    0 <= f.parent < len(entries) and
+                    entries[f.parent].ftype & 16):
+                report.errors.append(f'{path}: bad parent {f.parent}')
+            dchunks: list[int] = []
+            fc_off = f.offset
+            while fc_off != -1 and claim(fc_off, f'index of {path}'):
+                fc = FileChunk(chunk(fc_off))
+                dchunks += fc.dchunks
+                fc_off = fc.next_chunk
+            for c in dchunks:
+                if claim(c, f'data of {path}'):
+                    check_xor(c, f'{path} data')
+            if len(dchunks) * (cs - CHUNK_HEADER_SIZE) < f.size:
+                report.errors.append(f'{path}: size {f.size} is larger '
+                                     f'than its {len(dchunks)} chunks')
+            if f.offset != -1:
+                members.append((path, f))
+
+        if check_xor(1, 'free map') and check_xor(2, 'free map'):
+            bitmap = chunk(1)[CHUNK_HEADER_SIZE:]
+            for c in range(4, n):
+                bit = c - 1
+                if bit // 8 >= len(bitmap):
+                    break
+                free = bitmap[bit // 8] >> (bit % 8) & 1
+                if c in owner and free:
+                    report.free_but_used.append(c)
+                elif c not in owner and not free:
+                    report.leaked.append(c)
+
+    if decode and members:
+        name = getattr(fd, 'name', None)
+        if not isinstance(name, str):
+            raise ValueError('Decoding members needs a file with a name')
+        jobs = [(name, f.serialize(), password) for _, f in members]
+        if workers == 1 or len(jobs) < 2:
+            results = list(map(_decode_member, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_decode_member, jobs))
+        for (path, _), error in zip(members, results):
+            if error is not None:
+                report.bad_members[path] = error
+        report.members_checked = len(members)
+    return report
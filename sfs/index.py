@@ -0,0 +1,186 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Metadata index of an archive: the DirectoryTree chunks, the FileChunk
+# chains and the free chunks. It is kept in memory and in a sidecar file
+# next to the archive, and is only trusted while the size, mtime and header
+# of the archive are unchanged.
+
+from dataclasses import dataclass
+import os
+import struct
+import threading
+
+from sfs.sfs import SFSContainer
+from sfs.structs import FileChunk, HEADER_SIZE
+
+
+INDEX_MAGIC = b'SFSIDX01'
+INDEX_SUFFIX = '.sfsidx'
+
+
+@dataclass(slots=True)
+class ArchiveIndex:
+    size: int
+    mtime_ns: int
+    header: bytes
+    tree: list[tuple[int, bytes]]
+    file_chunks: dict[int, list[tuple[int, FileChunk]]]
+    free: set[int]
+    last_chunk: int
+
+    def is_valid(self, size: int, mtime_ns: int, header: bytes) -> bool:
+        return (self.size == size and self.mtime_ns == mtime_ns and
+                self.header == header)
+
+    def serialize(self) -> bytes:
+        parts = [struct.pack('<8sQQ364sIII', INDEX_MAGIC, self.size,
+                             self.mtime_ns, self.header, len(self.tree),
+                             len(self.file_chunks), self.last_chunk)]
+        for chunk_idx, chunk in self.tree:
+            parts.append(struct.pack('<iI', chunk_idx, len(chunk)) + chunk)
+        for head, chain in self.file_chunks.items():
+            parts.append(struct.pack('<iI', head, len(chain)))
+            for fc_off, fc in chain:
+                parts.append(struct.pack(
+                    f'<iiIIIIIIII{len(fc.dchunks)}i', fc_off,
+                    fc.next_chunk, fc.i, fc.j, fc.k, fc.l, fc.m, fc.n, fc.o,
+                    len(fc.dchunks), *fc.dchunks))
+        free = sorted(self.free)
+        parts.append(struct.pack(f'<I{len(free)}i', len(free), *free))
+        return b''.join(parts)
+
+    @classmethod
+    def parse(cls, data: bytes) -> 'ArchiveIndex':
+        (magic, size, mtime_ns, header, n_tree, n_chains,
+         last_chunk) = struct.unpack_from('<8sQQ364sIII', data)
+        if magic != INDEX_MAGIC:
+            raise ValueError('Not an SFS index')
+        pos = struct.calcsize('<8sQQ364sIII')
+
+        tree = []
+        for _ in range(n_tree):
+            chunk_idx, length = struct.unpack_from('<iI', data, pos)
+            pos += 8
+            tree.append((chunk_idx, data[pos:pos + length]))
+            pos += length
+
+        file_chunks = {}
+        for _ in range(n_chains):
+            head, length = struct.unpack_from('<iI', data, pos)
+            pos += 8
+            chain = []
+            for _ in range(length):
+                fc_off, *fields, n = struct.unpack_from('<iiIIIIIIII',
+                                                        data, pos)
+                pos += 40
+                fcdata = struct.pack('<iIIIIIII', *fields)
+                fcdata += data[pos:pos + 4 * n] + b'\x00' * 4
+                pos += 4 * n
+                chain.append((fc_off, FileChunk(fcdata)))
+            file_chunks[head] = chain
+
+        n_free, = struct.unpack_from('<I', data, pos)
+        free = set(struct.unpack_from(f'<{n_free}i', data, pos + 4))
+        return cls(size, mtime_ns, header, tree, file_chunks, free,
+                   last_chunk)
+
+
+def build_index(sfs: SFSContainer) -> ArchiveIndex:
+    sfs._index = None
+    st = os.fstat(sfs.fd.fileno())
+    sfs.fd.seek(0)
+    header = sfs.fd.read(HEADER_SIZE)
+    tree = []
+    file_chunks = {}
+    for chunk_idx, dt in sfs.enumerate_tree():
+        tree.append((chunk_idx, sfs._get_chunk(chunk_idx)))
+        for f in dt.files:
+            if f.offset != -1:
+                file_chunks[f.offset] = list(sfs.enumerate_file_chunks(f))
+    sfs._refresh_empty_chunks()
+    return ArchiveIndex(st.st_size, st.st_mtime_ns, header, tree,
+                        file_chunks, set(sfs._empty_chunks),
+                        sfs._last_chunk)
+
+
+_cache: dict[str, ArchiveIndex] = {}
+_cache_lock = threading.Lock()
+
+
+def _load_sidecar(path: str) -> None | ArchiveIndex:
+    try:
+        with open(path + INDEX_SUFFIX, 'rb') as fd:
+            return ArchiveIndex.parse(fd.read())
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def _save_sidecar(path: str, index: ArchiveIndex) -> None:
+    tmp = f'{path}{INDEX_SUFFIX}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as fd:
+            fd.write(index.serialize())
+        os.replace(tmp, path + INDEX_SUFFIX)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def open_archive(path: str, writable: bool = False,
+                 sidecar: bool = True,
+                 password: None | bytes = None) -> SFSContainer:
+    # Open an archive reusing the cached or sidecar metadata when it is
+    # still fresh, otherwise walk the archive and refresh both
+    path = os.path.abspath(path)
+    fd = open(path, 'rb+' if writable else 'rb')
+    sfs = SFSContainer(fd, password)
+    if sfs._cipher is not None:
+        # the index holds decrypted metadata, keep it in memory only
+        sidecar = False
+    st = os.fstat(fd.fileno())
+    fd.seek(0)
+    header = fd.read(HEADER_SIZE)
+
+    with _cache_lock:
+        index = _cache.get(path)
+    if index is None or not index.is_valid(st.st_size, st.st_mtime_ns,
+                                           header):
+        index = _load_sidecar(path) if sidecar else None
+        if index is None or not index.is_valid(st.st_size, st.st_mtime_ns,
+                                               header):
+            index = build_index(sfs)
+            if sidecar:
+                _save_sidecar(path, index)
+        with _cache_lock:
+            _cache[path] = index
+    sfs._index = index
+    return sfs
+
+
+def clear_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,119 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Random access into the zlib streams of AACS members, in the manner of
+# zlib's zran example: while a stream is inflated once, the decompressor is
+# copied every span bytes of output, and a later read of a range resumes
+# from the nearest copy instead of inflating from the start. Python's zlib
+# cannot prime a decompressor at a bit offset, so the checkpoints are these
+# copies, holding the 32KiB window, and live in memory only.
+
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Callable
+import zlib
+
+from sfs.utils import aacs_inflate
+
+
+# Deflated bytes handed to the decompressor at a time
+INPUT_BLOCK = 0x4000
+
+
+@dataclass(slots=True)
+class Checkpoint:
+    in_offset: int
+    out_offset: int
+    state: 'zlib._Decompress'
+
+
+@dataclass(slots=True)
+class InflateIndex:
+    span: int
+    size: int
+    checkpoints: list[Checkpoint]
+
+    def nearest(self, offset: int) -> Checkpoint:
+        i = bisect_right(self.checkpoints, offset,
+                         key=lambda cp: cp.out_offset)
+        return self.checkpoints[max(0, i - 1)]
+
+
+def inflate_indexed(deflated: bytes, span: int
+                    ) -> tuple[bytes, InflateIndex]:
+    if span <= 0:
+        raise ValueError(f'Bad checkpoint span {span}')
+    view = memoryview(deflated)
+    d = zlib.decompressobj()
+    checkpoints = [Checkpoint(0, 0, d.copy())]
+    out = []
+    pos = consumed = 0
+    while not d.eof:
+        piece = view[consumed:consumed + INPUT_BLOCK]
+        if not piece:
+            raise ValueError('Truncated deflate stream')
+        data = d.decompress(piece, span - pos % span)
+        consumed += len(piece) - len(d.unconsumed_tail)
+        out.append(data)
+        pos += len(data)
+        if data and pos % span == 0 and not d.eof:
+            checkpoints.append(Checkpoint(consumed, pos, d.copy()))
+    return b''.join(out), InflateIndex(span, pos, checkpoints)
+
+
+def inflate_range(index: InflateIndex, read: Callable[[int, int], bytes],
+                  start: int, end: int) -> bytes:
+    # read(offset, n) returns up to n bytes of the deflated stream
+    end = min(end, index.size)
+    start = min(start, end)
+    if start == end:
+        return b''
+    cp = index.nearest(start)
+    d = cp.state.copy()
+    pos, consumed = cp.out_offset, cp.in_offset
+    out = []
+    while pos < end and not d.eof:
+        piece = read(consumed, INPUT_BLOCK)
+        if not piece:
+            raise ValueError('Truncated deflate stream')
+        data = d.decompress(piece, end - pos)
+        consumed += len(piece) - len(d.unconsumed_tail)
+        if pos + len(data) > start:
+            out.append(data[max(0, start - pos):])
+        pos += len(data)
+    return b''.join(out)
+
+
+def aacs_inflate_indexed(data: bytes, span: int
+                         ) -> tuple[bytes, None | InflateIndex]:
+    # aacs_inflate with its checks, also returning the checkpoints when the
+    # member is deflated
+    indexes = []
+
+    def inflate(deflated: bytes) -> bytes:
+        inflated, index = inflate_indexed(deflated, span)
+        indexes.append(index)
+        return inflated
+
+    return aacs_inflate(data, inflate), indexes[0] if indexes else None
@@ -0,0 +1,79 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# NumPy implementation of the SFS chunk encryption. Blocks within a chunk
+# are chained, but every chunk starts its own chain, so block j of all the
+# chunks of a member is encrypted at once as one batch.
+
+import numpy as np
+import numpy.typing as npt
+
+from sfs.aes import s_box, xtime
+from sfs.stats import timed
+from sfs.wrongaes import WrongAES
+
+
+SBOX = np.frombuffer(s_box, dtype=np.uint8)
+XTIME = np.frombuffer(xtime, dtype=np.uint8)
+
+# The state is stored column by column, as in sfs.aes.bytes2matrix
+SHIFT_ROWS = np.array([4 * ((c + r) % 4) + r
+                       for c in range(4) for r in range(4)])
+
+State = npt.NDArray[np.uint8]
+
+
+def mix_columns(s: State) -> State:
+    cols = s.reshape(-1, 4, 4)
+    t = np.bitwise_xor.reduce(cols, axis=2, keepdims=True)
+    cols = cols ^ t ^ XTIME[cols ^ np.roll(cols, -1, axis=2)]
+    result: State = cols.reshape(-1, 16)
+    return result
+
+
+def encrypt_blocks(s: State, round_keys: State) -> State:
+    s = s ^ round_keys[0]
+    for k in round_keys[1:-1]:
+        s = mix_columns(SBOX[s][:, SHIFT_ROWS]) ^ k
+    result: State = SBOX[s][:, SHIFT_ROWS] ^ round_keys[-1]
+    return result
+
+
+@timed('sfs_encrypt_chunks')
+def sfs_encrypt_chunks(chunks: list[bytes], key: bytes) -> list[bytes]:
+    # Same result as sfs_encrypt on each chunk, chunks must have the same
+    # size, a multiple of 16 bytes
+    cipher = WrongAES(key)
+    round_keys = np.array(cipher._key_matrices, dtype=np.uint8)
+    round_keys = round_keys.reshape(-1, 16)
+    iv0 = np.frombuffer(cipher.encrypt_block(b'\xff' * 16), dtype=np.uint8)
+
+    data = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+    data = data.reshape(len(chunks), -1, 16).copy()
+    iv = np.tile(iv0, (len(chunks), 1))
+    for j in range(data.shape[1]):
+        ct = encrypt_blocks(data[:, j] ^ iv, round_keys)
+        iv ^= ct
+        data[:, j] = ct
+    return [row.tobytes() for row in data.reshape(len(chunks), -1)]
@@ -0,0 +1,223 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# HTTP access to archive members: GET /<archive>/<member> under a root
+# directory. Range requests on stored members only read the chunks holding
+# the range, and decoded members are kept in a cache bounded in bytes and
+# keyed by their ETag. The ETag includes the size and modification time of
+# the archive, so a member rewritten in place gets a new one.
+
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import mimetypes
+import os
+import re
+from urllib.parse import unquote, urlsplit
+
+from sfs.cache import LRUCache
+from sfs.index import open_archive
+from sfs.structs import FileHeader
+
+
+# archive path, member path and ETag
+CacheKey = tuple[str, str, str]
+
+
+MemberCache = LRUCache[CacheKey]
+
+
+def etag(file: FileHeader, st: os.stat_result) -> str:
+    # the member's own times are not always updated when it is rewritten
+    mtime = round(file.times[2] * 1e9)
+    return (f'"{file.size:x}-{mtime:x}-{file.offset:x}-'
+            f'{st.st_size:x}-{st.st_mtime_ns:x}"')
+
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: str, size: int) -> None | tuple[int, int]:
+    # Start and end of a single byte range, None to send the whole member.
+    # Raises ValueError when the range cannot be satisfied.
+    m = _RANGE.match(header.strip())
+    if m is None or m.groups() == ('', ''):
+        return None
+    first, last = m.groups()
+    if not first:
+        if int(last) == 0:
+            raise ValueError(header)
+        return max(0, size - int(last)), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(int(last) + 1 if last else size, size)
+
+
+class MemberServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], root: str,
+                 password: None | bytes = None,
+                 cache_bytes: int = 64 << 20,
+                 sidecar: bool = False) -> None:
+        super().__init__(address, MemberRequestHandler)
+        self.root = os.path.realpath(root)
+        self.password = password
+        self.cache = MemberCache(cache_bytes)
+        # sidecar indexes are written next to the served archives, so they
+        # are only used when asked for
+        self.sidecar = sidecar
+
+    def resolve(self, url_path: str) -> None | tuple[str, str]:
+        # split the path where it stops being a directory on disk
+        parts = [p for p in unquote(url_path).split('/') if p]
+        if any(p in ('.', '..') for p in parts):
+            return None
+        path = self.root
+        for i, part in enumerate(parts):
+            path = os.path.join(path, part)
+            if os.path.isfile(path):
+                member = '/'.join(parts[i + 1:])
+                return (path, member) if member else None
+            if not os.path.isdir(path):
+                return None
+        return None
+
+
+class MemberRequestHandler(BaseHTTPRequestHandler):
+    server: MemberServer
+
+    def do_GET(self) -> None:
+        self._serve(True)
+
+    def do_HEAD(self) -> None:
+        self._serve(False)
+
+    def _serve(self, send_body: bool) -> None:
+        resolved = self.server.resolve(urlsplit(self.path).path)
+        if resolved is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        archive, member = resolved
+        try:
+            sfs = open_archive(archive, sidecar=self.server.sidecar,
+                               password=self.server.password)
+        except (OSError, ValueError, AssertionError,
+                NotImplementedError) as e:
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, repr(e))
+            return
+        with sfs.fd:
+            try:
+                f = sfs.find_file(member)
+            except FileNotFoundError:
+                f = None
+            if f is None or f.ftype & 16:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            tag = etag(f, os.fstat(sfs.fd.fileno()))
+            if tag in self.headers.get('If-None-Match', ''):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', tag)
+                self.end_headers()
+                return
+
+            password = self.server.password if f.encrypted else None
+            key = (archive, member, tag)
+            data = self.server.cache.get(key)
+            range_header = self.headers.get('Range')
+            # a range of a stored member is read straight from its chunks
+            # a member that fails to decode, from a wrong password or a
+            # corrupt stream, is answered like any other server error
+            try:
+                if data is None and (range_header is None or
+                                     sfs.is_compressed(f, password)):
+                    data = sfs.read_file(f, password)
+                    self.server.cache.put(key, data)
+            except Exception as e:
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, repr(e))
+                return
+            size = f.size if data is None else len(data)
+
+            try:
+                span = (None if range_header is None else
+                        parse_range(range_header, size))
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = (0, size) if span is None else span
+            if data is not None:
+                body = data[start:end]
+            else:
+                try:
+                    body = sfs.read_range(f, start, end, password)
+                except Exception as e:
+                    self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR,
+                                    repr(e))
+                    return
+
+        ctype = mimetypes.guess_type(member)[0] or 'application/octet-stream'
+        if span is None:
+            self.send_response(HTTPStatus.OK)
+        else:
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end - 1}/{size}')
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', tag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+def main(argv: None | list[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m sfs.server',
+        description='Serve the members of the archives under a directory')
+    parser.add_argument('root')
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--password-env', default='SFS_PASSWORD',
+                        help='environment variable holding the password')
+    parser.add_argument('--cache-mb', type=int, default=64)
+    parser.add_argument('--sidecar', action='store_true',
+                        help='keep index files next to the archives')
+    args = parser.parse_args(argv)
+    value = os.environ.get(args.password_env)
+    password = None if value is None else value.encode()
+    server = MemberServer((args.bind, args.port), args.root, password,
+                          args.cache_mb << 20, args.sidecar)
+    with server:
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,28 +22,134 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from io import BufferedReader
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dataclasses
 import os
-from typing import Iterator
+import struct
+import threading
+import zlib
+from typing import BinaryIO, Iterable, Iterator, TYPE_CHECKING
 from sfs.structs import (Header, DirectoryTree, FileChunk, FileHeader,
-                         FileDataChunk)
-from sfs.utils import make_chunks, aacs_inflate, aacs_deflate
+                         FileDataChunk, HEADER_SIZE, CHUNKS_OFFSET,
+                         CHUNK_HEADER_SIZE, entry_paths, unwrap_key,
+                         valid_chunk_size)
+from sfs.cache import member_cache, member_fingerprint
+from sfs.cipher import ChunkCipher
+from sfs.edit import MetadataBatch
+from sfs.fsck import VerifyReport, verify_archive
+from sfs.inflate import (InflateIndex, aacs_inflate_indexed, inflate_indexed,
+                         inflate_range)
+from sfs.stats import Hook, Stats, tracked
+from sfs.sync import SyncResult, sync_directory
+from sfs.utils import (make_chunks, aacs_header, aacs_inflate, aacs_deflate,
+                       aacs_deflate_parallel, choose_compression_level,
+                       make_free_map, free_map_capacity, copy_file,
+                       plausible_prefix, AACS_DATA_OFFSET)
+from sfs.wrongaes import checkxor, explode_key, sfs_decrypt
+
+if TYPE_CHECKING:
+    from sfs.index import ArchiveIndex
+
+
+# Below this many chunks read_many decodes in this process unless told how
+# many workers to use, starting a pool costs more than it saves
+PARALLEL_MIN_CHUNKS = 32
+
+
+def member_data(chunks: Iterable[bytes], key: None | bytes) -> bytes:
+    # chunks may be a generator, each one is decrypted as it arrives
+    fdcs = (FileDataChunk(chunk) for chunk in chunks)
+    if key is not None:
+        return b''.join(chunk.decrypt(key) for chunk in fdcs)
+    return b''.join(chunk.data for chunk in fdcs)
+
+
+def decode_data(data: bytes, size: int) -> bytes:
+    if data[:4] == b'AACS':
+        data = aacs_inflate(data)
+    else:
+        assert len(data) >= size
+        assert all(b == 0 for b in data[size:]), 'Invalid padding'
+        data = data[:size]
+
+    return data
+
+
+def decode_member(chunks: Iterable[bytes], key: None | bytes,
+                  size: int) -> bytes:
+    return decode_data(member_data(chunks, key), size)
+
+
+def _probe_password(job: tuple[bytes, bytes, bytes, int]) -> bool:
+    password, key, prefix, size = job
+    data = bytearray(prefix)
+    sfs_decrypt(data, unwrap_key(key, explode_key(password)))
+    return plausible_prefix(bytes(data), size)
 
 
 class SFSContainer:
-    def __init__(self, fd: BufferedReader) -> None:
+    def __init__(self, fd: BinaryIO, password: None | bytes = None,
+                 cipher: None | ChunkCipher = None) -> None:
+        # cipher stands in for the password of an encrypted archive when
+        # the archive key is already unwrapped, as in clone
         self.fd = fd
-        hdrbytes = fd.read(364)
+        hdrbytes = fd.read(HEADER_SIZE)
         self._hdr = Header(hdrbytes)
-        if self._hdr.chunk_size != 4096:
-            raise NotImplementedError()
+        if not valid_chunk_size(self._hdr.chunk_size):
+            raise NotImplementedError(
+                f'Unsupported chunk size {self._hdr.chunk_size}')
+        self._cipher = None
+        if self._hdr.encrypted and cipher is not None:
+            self._cipher = ChunkCipher(cipher.key, cipher.cache_size)
+        elif self._hdr.encrypted:
+            if password is None:
+                raise ValueError('The archive is encrypted, '
+                                 'a password is needed')
+            self._cipher = ChunkCipher(self._hdr.decrypt_key(password))
         self._empty_chunks: set[int] = set()
         self._last_chunk = -1
+        # _io_lock covers each seek and its read or write, _alloc_lock the
+        # free chunks, and _commit_cond the metadata waiting for a group
+        # commit; they are always taken in the order alloc, then io
+        self._io_lock = threading.Lock()
+        self._alloc_lock = threading.RLock()
+        self._commit_cond = threading.Condition()
+        self._pending: dict[int, FileHeader] = {}
+        self._superseded: list[FileHeader] = []
+        self._committing = False
+        self._next_batch = 1
+        self._committed = 0
+        self._commit_errors: dict[int, Exception] = {}
+        self._batch_waiters: dict[int, int] = {}
+        # number of data chunks read_file asks the kernel to read ahead
+        self.prefetch_depth = 16
+        # bytes of output between the inflate checkpoints kept for
+        # compressed members so read_range can start midway, None for none;
+        # they are made when a member is read whole or written and keyed by
+        # its first FileChunk, and all dropped on any write
+        self.inflate_span: None | int = None
+        self._inflate_indexes: dict[int, InflateIndex] = {}
+        # metadata loaded by sfs.index.open_archive, dropped on any write
+        self._index: None | ArchiveIndex = None
+        self.stats: None | Stats = None
 
+    def enable_stats(self, hook: None | Hook = None) -> Stats:
+        self.stats = Stats(hook)
+        return self.stats
+
+    def disable_stats(self) -> None:
+        self.stats = None
+
+    @tracked()
     def _refresh_empty_chunks(self) -> None:
-        last_byte = self.fd.seek(0, 2)
-        assert 0 == (last_byte - 280) % self._hdr.chunk_size
-        self._last_chunk = (last_byte - 280) // self._hdr.chunk_size
+        if self._index is not None:
+            self._empty_chunks = set(self._index.free)
+            self._last_chunk = self._index.last_chunk
+            return
+        with self._io_lock:
+            last_byte = self.fd.seek(0, 2)
+        assert 0 == (last_byte - CHUNKS_OFFSET) % self._hdr.chunk_size
+        self._last_chunk = (last_byte - CHUNKS_OFFSET) // self._hdr.chunk_size
         used_chunks = {0, 1, 2, 3}
         for chk_idx, dt in self.enumerate_tree():
             assert chk_idx not in used_chunks
@@ -58,34 +164,173 @@ class SFSContainer:
         self._empty_chunks = set(range(self._last_chunk)
                                  ).difference(used_chunks)
 
+    @tracked('get_chunk')
     def _get_chunk(self, c: int) -> bytes:
         if c <= 0:
             raise ValueError(f'Requested invalid chunk {c}')
-        pos = c * self._hdr.chunk_size + 280
-        self.fd.seek(pos)
-        data = self.fd.read(self._hdr.chunk_size)
+        with self._io_lock:
+            self.fd.seek(self._hdr.chunk_position(c))
+            data = self.fd.read(self._hdr.chunk_size)
         if len(data) == 0:
             raise ValueError(f'Requested invalid chunk {c} (out of file)')
         assert len(data) == self._hdr.chunk_size
+        if self._cipher is not None:
+            data = self._cipher.decrypt(c, data)
         return data
 
+    @tracked('put_chunk')
     def _put_chunk(self, c: int, buf: bytes) -> None:
         if c <= 0:
             raise ValueError(f'Requested invalid chunk {c}')
         if len(buf) != self._hdr.chunk_size:
             xp = self._hdr.chunk_size
             raise ValueError(f'Chunk has size {len(buf)}, expected {xp}')
-        pos = c * self._hdr.chunk_size + 280
-        self.fd.seek(pos)
-        self.fd.write(buf)
+        self._index = None
+        self._inflate_indexes.clear()
+        if self._cipher is not None:
+            buf = self._cipher.encrypt(c, buf)
+        with self._io_lock:
+            self.fd.seek(self._hdr.chunk_position(c))
+            self.fd.write(buf)
+
+    def _put_header(self) -> None:
+        self._index = None
+        with self._io_lock:
+            self.fd.seek(0)
+            self.fd.write(self._hdr.serialize())
+
+    def _allocate_chunks(self, n: int) -> list[int]:
+        with self._alloc_lock:
+            if self._last_chunk == -1:
+                self._refresh_empty_chunks()
+            chunks = sorted(self._empty_chunks)[:n]
+            self._empty_chunks.difference_update(chunks)
+            while len(chunks) < n:
+                chunks.append(self._last_chunk)
+                self._last_chunk += 1
+            if self._last_chunk > self._hdr.n_chunks:
+                self._hdr.n_chunks = self._last_chunk
+                self._put_header()
+        return chunks
+
+    def _put_free_map(self) -> None:
+        with self._alloc_lock:
+            if self._last_chunk == -1:
+                self._refresh_empty_chunks()
+            # the map only has room for the first chunks of a large
+            # archive, the rest are found from the tree like everywhere else
+            n = min(self._last_chunk, free_map_capacity(self._hdr.chunk_size))
+            bodies = make_free_map(self._empty_chunks, n, self._hdr.chunk_size)
+            for c, body in zip([1, 2], bodies):
+                chunk = bytearray(self._get_chunk(c))
+                chunk[4:8] = struct.pack('<I', checkxor(body))
+                chunk[CHUNK_HEADER_SIZE:] = body
+                self._put_chunk(c, bytes(chunk))
+
+    def _free_file_chunks(self, file: FileHeader) -> None:
+        if file.offset == -1:
+            return
+        with self._alloc_lock:
+            for fc_off, fc in self.enumerate_file_chunks(file):
+                self._empty_chunks.add(fc_off)
+                self._empty_chunks.update(fc.dchunks)
+
+    def _write_file_chunks(self, dchunks: list[int]) -> int:
+        # write a new FileChunk chain indexing dchunks, return its head
+        if not dchunks:
+            return -1
+        capacity = FileChunk.capacity(self._hdr.chunk_size)
+        offsets = self._allocate_chunks(-(-len(dchunks) // capacity))
+        return self._put_file_chunks(offsets, dchunks)
+
+    def _put_file_chunks(self, offsets: list[int], dchunks: list[int]) -> int:
+        capacity = FileChunk.capacity(self._hdr.chunk_size)
+        n = len(offsets)
+        for i, fc_off in enumerate(offsets):
+            fc = FileChunk.empty(self._hdr.chunk_size)
+            fc.dchunks = dchunks[i * capacity:(i + 1) * capacity]
+            if i + 1 < n:
+                fc.next_chunk = offsets[i + 1]
+            self._put_chunk(fc_off, fc.serialize(self._hdr.chunk_size))
+        return offsets[0]
+
+    def _add_entry(self, file: FileHeader) -> int:
+        capacity = DirectoryTree.capacity(self._hdr.chunk_size)
+        chunk_idx, dt = -1, None
+        for chunk_idx, dt in self.enumerate_tree():
+            pass
+        assert dt is not None
+        if len(dt.files) < capacity:
+            dt.files.append(file)
+            self._put_chunk(chunk_idx, dt.serialize(self._hdr.chunk_size))
+        else:
+            new_idx, = self._allocate_chunks(1)
+            new_dt = DirectoryTree(b'\x00' * self._hdr.chunk_size, 0)
+            (new_dt.c, new_dt.d, new_dt.e, new_dt.f, new_dt.g,
+             new_dt.h) = dt.c, dt.d, dt.e, dt.f, dt.g, dt.h
+            new_dt.next_chunk = new_idx
+            new_dt.files.append(file)
+            self._put_chunk(new_idx, new_dt.serialize(self._hdr.chunk_size))
+            dt.next_chunk = new_idx
+            self._put_chunk(chunk_idx, dt.serialize(self._hdr.chunk_size))
+        self._hdr.n_entr += 1
+        self._put_header()
+        return self._hdr.n_entr - 1
+
+    def _replace_entry(self, index: int, file: FileHeader) -> None:
+        for chunk_idx, dt in self.enumerate_tree():
+            if index < len(dt.files):
+                dt.files[index] = file
+                self._put_chunk(chunk_idx,
+                                dt.serialize(self._hdr.chunk_size))
+                return
+            index -= len(dt.files)
+        raise IndexError('Entry index out of range')
+
+    def _put_entries(self, entries: list[FileHeader]) -> None:
+        # Lay out the whole entry list over the tree chain, growing or
+        # shrinking the chain and writing only the chunks that change
+        cs = self._hdr.chunk_size
+        capacity = DirectoryTree.capacity(cs)
+        tree = list(self.enumerate_tree())
+        n = max(1, -(-len(entries) // capacity))
+        chain = [c for c, _ in tree[:n]]
+        chain += self._allocate_chunks(n - len(chain))
+        first = tree[0][1]
+        for i, c in enumerate(chain):
+            if i < len(tree):
+                dt = tree[i][1]
+                old = dt.serialize(cs)
+            else:
+                dt = DirectoryTree(b'\x00' * cs, 0)
+                dt.c, dt.d, dt.e, dt.f, dt.g, dt.h = (
+                    first.c, first.d, first.e, first.f, first.g, first.h)
+                old = b''
+            dt.files = entries[i * capacity:(i + 1) * capacity]
+            dt.next_chunk = chain[min(i + 1, n - 1)]
+            new = dt.serialize(cs)
+            if new != old:
+                self._put_chunk(c, new)
+        if self._hdr.n_entr != len(entries):
+            self._hdr.n_entr = len(entries)
+            self._put_header()
+        # the chunks left off the end of the chain are free once it is cut
+        self._empty_chunks.update(c for c, _ in tree[n:])
 
     def get_tree(self) -> Iterator[DirectoryTree]:
         for _, dt in self.enumerate_tree():
             yield dt
 
+    @tracked()
     def enumerate_tree(self) -> Iterator[tuple[int, DirectoryTree]]:
-        nco = self._hdr.tree_offset
         rem_entries = self._hdr.n_entr
+        if self._index is not None:
+            for nco, chunk in self._index.tree:
+                dt = DirectoryTree(chunk, rem_entries)
+                rem_entries -= len(dt.files)
+                yield nco, dt
+            return
+        nco = self._hdr.tree_offset
         while 1:
             chunk = self._get_chunk(nco)
             dt = DirectoryTree(chunk, rem_entries)
@@ -96,68 +341,529 @@ class SFSContainer:
                 break
             nco = dt.next_chunk
 
+    def get_entries(self) -> list[FileHeader]:
+        return [f for dt in self.get_tree() for f in dt.files]
+
+    def walk(self) -> Iterator[tuple[str, FileHeader]]:
+        entries = self.get_entries()
+        yield from zip(entry_paths(entries), entries)
+
+    def edit_metadata(self) -> MetadataBatch:
+        # Renames, moves and time updates written together on commit, or
+        # when used as a context manager, on leaving it
+        return MetadataBatch(self)
+
+    def _find_index(self, path: str) -> int:
+        for i, (p, _) in enumerate(self.walk()):
+            if p == path:
+                return i
+        raise FileNotFoundError(path)
+
+    def find_file(self, path: str) -> FileHeader:
+        for p, f in self.walk():
+            if p == path:
+                return f
+        raise FileNotFoundError(path)
+
+    @tracked()
     def write_file(self, file: FileHeader, data: bytes,
                    password: None | bytes = None,
-                   compression_level: None | int = 1) -> None:
+                   compression_level: None | int = 1,
+                   adaptive: bool = False,
+                   workers: None | int = None,
+                   differential: bool = False) -> None:
+        # With differential, each new chunk is compared with the one on disk
+        # and only those that differ are written. Encryption restarts on
+        # every chunk, so equal plaintext gives equal chunks; this pays off
+        # for uncompressed members, where an edit does not move later bytes.
 
         key = None if password is None else file.decrypt_key(password)
 
         # deflate if needed
         if compression_level is not None:
-            data = aacs_deflate(data, compression_level)
+            if adaptive:
+                compression_level = choose_compression_level(
+                    data, compression_level)
+            if workers is not None and workers != 1:
+                data = aacs_deflate_parallel(data, compression_level,
+                                             workers or None)
+            else:
+                data = aacs_deflate(data, compression_level)
+
+        chunks = make_chunks(data, self._hdr.chunk_size, key)
+
+        # grow or shrink the member through the allocator, keeping its
+        # chunks and FileChunk chain in place as far as they go
+        chain = list(self.enumerate_file_chunks(file))
+        offsets = [fc_off for fc_off, _ in chain]
+        dchunks = [c for _, fc in chain for c in fc.dchunks]
+        n_old = len(dchunks)
+        if len(chunks) != n_old:
+            capacity = FileChunk.capacity(self._hdr.chunk_size)
+            n_fc = -(-len(chunks) // capacity)
+            with self._alloc_lock:
+                if self._last_chunk == -1:
+                    self._refresh_empty_chunks()
+                if len(chunks) > n_old:
+                    dchunks += self._allocate_chunks(len(chunks) - n_old)
+                else:
+                    self._empty_chunks.update(dchunks[len(chunks):])
+                    del dchunks[len(chunks):]
+                if n_fc > len(offsets):
+                    offsets += self._allocate_chunks(n_fc - len(offsets))
+                else:
+                    self._empty_chunks.update(offsets[n_fc:])
+                    del offsets[n_fc:]
+                if offsets:
+                    self._put_file_chunks(offsets, dchunks)
+                self._put_free_map()
+        offset = offsets[0] if offsets else -1
 
         for chunk_idx, dt in self.enumerate_tree():
             for f in dt.files:
-                if f == file:
-                    # must rewrite this directorytree with the updated size
+                if f == file and (f.size, f.offset) != (len(data), offset):
+                    # must rewrite this directorytree with the updated entry
                     f.size = len(data)
+                    f.offset = offset
                     b = dt.serialize(self._hdr.chunk_size)
                     self._put_chunk(chunk_idx, b)
+        file.size = len(data)
+        file.offset = offset
+
+        for i, chunk in enumerate(chunks):
+            idx = dchunks[i]
+            if differential and i < n_old and self._get_chunk(idx) == chunk:
+                continue
+            self._put_chunk(idx, chunk)
 
+        if (self.inflate_span is not None and compression_level is not None
+                and data[:4] == b'AACS'):
+            level, avail_in, _, _ = aacs_header(data)
+            if level != 0:
+                self._inflate_indexes[file.offset] = inflate_indexed(
+                    data[AACS_DATA_OFFSET:AACS_DATA_OFFSET + avail_in],
+                    self.inflate_span)[1]
+
+    @tracked()
+    def update_file(self, path: str, data: bytes,
+                    password: None | bytes = None,
+                    compression_level: None | int = 1) -> FileHeader:
+        # Safe to call from several threads at once. The new contents are
+        # encoded without holding any lock and written to newly allocated
+        # chunks, then the entry is switched over by a group commit shared
+        # with the other writers, which also frees the old chunks.
+        for index, (p, f) in enumerate(self.walk()):
+            if p == path:
+                break
+        else:
+            raise FileNotFoundError(path)
+        file = FileHeader(f.serialize())
+        key = None
+        if password is not None and file.encrypted:
+            key = file.decrypt_key(password)
+        if compression_level is not None:
+            data = aacs_deflate(data, compression_level)
         chunks = make_chunks(data, self._hdr.chunk_size, key)
 
-        file_chunk = FileChunk(self._get_chunk(file.offset))
-        if len(chunks) > len(file_chunk.dchunks):
-            # TODO: allocate new chunks
-            raise NotImplementedError()
+        file.size = len(data)
+        file.offset = -1
+        if chunks:
+            capacity = FileChunk.capacity(self._hdr.chunk_size)
+            n_fc = -(-len(chunks) // capacity)
+            offsets = self._allocate_chunks(n_fc + len(chunks))
+            dchunks = offsets[n_fc:]
+            for c, chunk in zip(dchunks, chunks):
+                self._put_chunk(c, chunk)
+            file.offset = self._put_file_chunks(offsets[:n_fc], dchunks)
+        self._group_commit(index, file)
+        return file
 
-        if len(chunks) < len(file_chunk.dchunks):
-            unused_chunks = file_chunk.dchunks[len(chunks):]
-            file_chunk.dchunks = file_chunk.dchunks[:len(chunks)]
-            for c in unused_chunks:
-                self._empty_chunks.add(c)
+    def _group_commit(self, index: int, file: FileHeader) -> None:
+        # The first writer to find no commit running commits the updates of
+        # everybody waiting, the others sleep until their batch is written
+        with self._commit_cond:
+            if index in self._pending:
+                self._superseded.append(self._pending[index])
+            self._pending[index] = file
+            batch = self._next_batch
+            self._batch_waiters[batch] = self._batch_waiters.get(batch, 0) + 1
+            while self._committed < batch:
+                if self._committing:
+                    self._commit_cond.wait()
+                    continue
+                self._committing = True
+                pending, self._pending = self._pending, {}
+                superseded, self._superseded = self._superseded, []
+                self._next_batch += 1
+                self._commit_cond.release()
+                try:
+                    self._apply_commit(pending, superseded)
+                except Exception as e:
+                    self._commit_errors[batch] = e
+                finally:
+                    self._commit_cond.acquire()
+                    self._committing = False
+                    self._committed = batch
+                    self._commit_cond.notify_all()
+            error = self._commit_errors.get(batch)
+            # the last waiter of a batch drops its entries
+            self._batch_waiters[batch] -= 1
+            if not self._batch_waiters[batch]:
+                del self._batch_waiters[batch]
+                self._commit_errors.pop(batch, None)
+        if error is not None:
+            raise error
 
-        for i, chunk in enumerate(chunks):
-            idx = file_chunk.dchunks[i]
-            self._put_chunk(idx, chunk)
+    def _apply_commit(self, pending: dict[int, FileHeader],
+                      superseded: list[FileHeader]) -> None:
+        # The old chunks are freed only once the entries pointing away from
+        # them are written. If that fails the old members stay as they were
+        # and the chunks written for the batch are given back instead.
+        with self._alloc_lock:
+            try:
+                entries = self.get_entries()
+                old = [entries[index] for index in pending]
+                for index, file in pending.items():
+                    entries[index] = file
+                self._put_entries(entries)
+            except Exception:
+                for file in list(pending.values()) + superseded:
+                    self._free_file_chunks(file)
+                raise
+            for file in old + superseded:
+                self._free_file_chunks(file)
+            self._put_free_map()
 
-    def read_file(self, file: FileHeader,
-                  password: None | bytes = None) -> bytes:
+    @tracked()
+    def rekey(self, old_password: bytes, new_password: bytes) -> None:
+        # With a wrong old password the keys would be re-wrapped into
+        # garbage, so it is checked on a member before anything is written.
+        # The archive key of a whole-archive encrypted file goes last.
+        if (self._cipher is not None and
+                self._hdr.decrypt_key(old_password) != self._cipher.key):
+            raise ValueError('Wrong password for the archive')
+        if (any(f.encrypted and f.offset != -1 and f.size > 0
+                for _, f in self.walk()) and
+                self.probe_password([old_password], workers=1) is None):
+            raise ValueError('Wrong password for the encrypted members')
+        for chunk_idx, dt in self.enumerate_tree():
+            changed = False
+            for f in dt.files:
+                if f.encrypted:
+                    f.rekey(old_password, new_password)
+                    changed = True
+            if changed:
+                self._put_chunk(chunk_idx, dt.serialize(self._hdr.chunk_size))
+        if self._cipher is not None:
+            self._hdr.rekey(old_password, new_password)
+            self._put_header()
+
+    @tracked()
+    def copy_member(self, src: 'SFSContainer', path: str,
+                    password: None | bytes = None,
+                    new_password: None | bytes = None) -> FileHeader:
+        # Move the encrypted and compressed chunks as they are, only the
+        # key in the header is re-wrapped when the passwords differ
+        if src._hdr.chunk_size != self._hdr.chunk_size:
+            raise ValueError('Containers have different chunk sizes')
+        file = FileHeader(src.find_file(path).serialize())
+        if new_password is not None and file.encrypted:
+            if password is None:
+                raise ValueError('The source password is needed to rekey')
+            file.rekey(password, new_password)
+
+        dirname, _, _ = path.rpartition('/')
+        file.parent = self._find_index(dirname) if dirname else -1
+
+        offs = src._get_data_chunk_indexes(file)
+        dchunks = self._allocate_chunks(len(offs))
+        for i, j in zip(offs, dchunks):
+            self._put_chunk(j, src._get_chunk(i))
+        file.offset = self._write_file_chunks(dchunks)
+
+        try:
+            index = self._find_index(path)
+        except FileNotFoundError:
+            self._add_entry(file)
+        else:
+            old = self.get_entries()[index]
+            self._replace_entry(index, file)
+            self._free_file_chunks(old)
+        self._put_free_map()
+        return file
+
+    def _get_data_chunk_indexes(self, file: FileHeader) -> list[int]:
         if file.offset == -1:
-            return b''
-        offs = sum([
+            return []
+        return sum([
             fc.dchunks
             for _, fc in self.enumerate_file_chunks(file)
         ], [])
-        chunks = [FileDataChunk(self._get_chunk(i)) for i in offs]
 
-        if password is not None:
-            key = file.decrypt_key(password)
-            data = b''.join(chunk.decrypt(key) for chunk in chunks)
-        else:
-            data = b''.join(chunk.data for chunk in chunks)
+    @tracked()
+    def read_file(self, file: FileHeader,
+                  password: None | bytes = None) -> bytes:
+        if file.offset == -1:
+            return b''
+        offs = self._get_data_chunk_indexes(file)
+        cache = member_cache()
+        if cache is None:
+            return self._decode_file(file, self._read_ahead(offs), password)
+        chunks = list(self._read_ahead(offs))
+        fingerprint = member_fingerprint(
+            chunks, file.key, password if file.encrypted else None, file.size)
+        data = cache.get(fingerprint)
+        if data is None:
+            data = self._decode_file(file, chunks, password)
+            cache.put(fingerprint, data)
+        return data
+
+    def _decode_file(self, file: FileHeader, chunks: Iterable[bytes],
+                     password: None | bytes) -> bytes:
+        key = None if password is None else file.decrypt_key(password)
+        data = member_data(chunks, key)
+        if (self.inflate_span is not None and data[:4] == b'AACS' and
+                file.offset not in self._inflate_indexes):
+            data, index = aacs_inflate_indexed(data, self.inflate_span)
+            if index is not None:
+                self._inflate_indexes[file.offset] = index
+            return data
+        return decode_data(data, file.size)
 
+    def _read_ahead(self, offs: list[int]) -> Iterator[bytes]:
+        # Yield the chunks in order, keeping the next prefetch_depth of them
+        # requested from the kernel while the caller decodes
+        depth = self.prefetch_depth
+        self._prefetch(offs[:depth])
+        for i, c in enumerate(offs):
+            if depth > 0:
+                self._prefetch(offs[i + depth:i + depth + 1])
+            yield self._get_chunk(c)
+
+    def _prefetch(self, offs: list[int]) -> None:
+        if not offs or not hasattr(os, 'posix_fadvise'):
+            return
+        cs = self._hdr.chunk_size
+        try:
+            fileno = self.fd.fileno()
+            for c in offs:
+                os.posix_fadvise(fileno, self._hdr.chunk_position(c), cs,
+                                 os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+    def is_compressed(self, file: FileHeader,
+                      password: None | bytes = None) -> bool:
+        if file.offset == -1:
+            return False
+        fdc = FileDataChunk(self._get_chunk(
+            next(self.enumerate_file_chunks(file))[1].dchunks[0]))
+        key = None if password is None else file.decrypt_key(password)
+        data = fdc.data if key is None else fdc.decrypt(key)
+        return data[:4] == b'AACS'
+
+    @tracked()
+    def read_range(self, file: FileHeader, start: int, end: int,
+                   password: None | bytes = None) -> bytes:
+        # Bytes start:end of a member. Only the chunks holding them are read,
+        # except for deflated members without inflate checkpoints, which are
+        # decoded whole (making the checkpoints when inflate_span is set).
+        if file.offset == -1:
+            return b''
+        offs = self._get_data_chunk_indexes(file)
+        key = None if password is None else file.decrypt_key(password)
+        body = self._hdr.chunk_size - CHUNK_HEADER_SIZE
+        decoded: dict[int, bytes] = {}
+
+        def read(offset: int, n: int) -> bytes:
+            # n bytes of the member data from offset, padding included
+            stop = min(offset + n, len(offs) * body)
+            if offset >= stop:
+                return b''
+            lo, hi = offset // body, (stop - 1) // body + 1
+            missing = sorted({offs[i] for i in range(lo, hi)
+                              if i not in decoded})
+            raw = self._get_chunks(missing)
+            for i in range(lo, hi):
+                if i not in decoded:
+                    fdc = FileDataChunk(raw[offs[i]])
+                    decoded[i] = fdc.data if key is None else fdc.decrypt(key)
+            data = b''.join(decoded[i] for i in range(lo, hi))
+            return data[offset - lo * body:stop - lo * body]
+
+        size = file.size
+        base = 0
+        head = read(0, AACS_DATA_OFFSET)
+        if head[:4] == b'AACS':
+            level, avail_in, size, _ = aacs_header(head)
+            index = self._inflate_indexes.get(file.offset)
+            if level != 0 and index is None:
+                return self.read_file(file, password)[start:end]
+            if level != 0 and index is not None:
+                return inflate_range(
+                    index, lambda off, n: read(AACS_DATA_OFFSET + off,
+                                               min(n, avail_in - off)),
+                    start, end)
+            base = AACS_DATA_OFFSET
+        end = min(end, size)
+        start = min(start, end)
+        return read(base + start, end - start)
+
+    @tracked()
+    def probe_password(self, candidates: Iterable[bytes],
+                       workers: None | int = None) -> None | bytes:
+        # The first candidate that decrypts an encrypted member. Only the
+        # first 32 bytes of it are decrypted and checked for a plausible
+        # start, and only when no candidate passes that are the candidates
+        # fully decoded, smallest member first, until a member can tell.
+        # Raises ValueError when no member can tell for any candidate.
+        candidates = list(candidates)
+        members = [f for _, f in self.walk()
+                   if f.encrypted and f.offset != -1 and f.size > 0]
+        if not members:
+            raise ValueError('The archive has no encrypted members')
+        file = members[0]
+        fdc = FileDataChunk(self._get_chunk(
+            self._get_data_chunk_indexes(file)[0]))
+        if fdc.flags & 0x100:
+            jobs = [(password, file.key, fdc.data[:32], file.size)
+                    for password in candidates]
+            if workers == 1 or len(jobs) < 2:
+                for password, job in zip(candidates, jobs):
+                    if _probe_password(job):
+                        return password
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for password, ok in zip(candidates, executor.map(
+                            _probe_password, jobs)):
+                        if ok:
+                            return password
+
+        members.sort(key=lambda f: f.size)
+        checked = False
+        for password in candidates:
+            verdict = None
+            for file in members:
+                verdict = self._check_password(file, password)
+                if verdict is not None:
+                    break
+            if verdict:
+                return password
+            checked = checked or verdict is not None
+        if candidates and not checked:
+            raise ValueError('None of the encrypted members can be checked')
+        return None
+
+    def _check_password(self, file: FileHeader,
+                        password: bytes) -> None | bool:
+        # Whether password decodes file, None when nothing in it can tell:
+        # an AACS stream carries a CRC and a stored member zero padding, but
+        # a stored member filling its last chunk has nothing to check
+        data = member_data(
+            self._read_ahead(self._get_data_chunk_indexes(file)),
+            file.decrypt_key(password))
         if data[:4] == b'AACS':
-            data = aacs_inflate(data)
-        else:
-            assert len(data) >= file.size
-            assert all(b == 0 for b in data[file.size:]), 'Invalid padding'
-            data = data[:file.size]
+            try:
+                aacs_inflate(data)
+            except (AssertionError, ValueError, struct.error, zlib.error):
+                return False
+            return True
+        if len(data) <= file.size:
+            return None
+        return not any(data[file.size:])
 
-        return data
+    @tracked()
+    def read_many(self, paths: Iterable[str], password: None | bytes = None,
+                  workers: None | int = None
+                  ) -> Iterator[tuple[str, bytes]]:
+        # Read the chunks of all the members in one ascending sweep, then
+        # decode them in parallel, yielding each member as it is done
+        files = dict(self.walk())
+        wanted = {}
+        for path in paths:
+            if path not in files:
+                raise FileNotFoundError(path)
+            wanted[path] = files[path]
+
+        offs = {path: self._get_data_chunk_indexes(f)
+                for path, f in wanted.items()}
+        if (workers is None and
+                sum(map(len, offs.values())) < PARALLEL_MIN_CHUNKS):
+            workers = 1
+        raw = self._get_chunks(sorted({c for o in offs.values() for c in o}),
+                               workers)
+
+        cache = member_cache()
+        password_key = None if password is None else explode_key(password)
+        keys: dict[bytes, bytes] = {}
+        jobs = []
+        for path, f in wanted.items():
+            chunks = [raw[c] for c in offs[path]]
+            fingerprint = b''
+            if cache is not None:
+                fingerprint = member_fingerprint(
+                    chunks, f.key, password if f.encrypted else None, f.size)
+                data = cache.get(fingerprint)
+                if data is not None:
+                    yield path, data
+                    continue
+            key = None
+            if password_key is not None and f.encrypted:
+                if f.key not in keys:
+                    keys[f.key] = f.unwrap_key(password_key)
+                key = keys[f.key]
+            jobs.append((path, chunks, key, f.size, fingerprint))
+
+        def done(path: str, fingerprint: bytes,
+                 data: bytes) -> tuple[str, bytes]:
+            if cache is not None:
+                cache.put(fingerprint, data)
+            return path, data
 
+        if workers == 1 or len(jobs) < 2:
+            for path, chunks, key, size, fingerprint in jobs:
+                yield done(path, fingerprint,
+                           decode_member(chunks, key, size))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(decode_member, chunks, key, size):
+                       (path, fingerprint)
+                       for path, chunks, key, size, fingerprint in jobs}
+            for future in as_completed(futures):
+                yield done(*futures[future], future.result())
+
+    @tracked('get_chunks')
+    def _get_chunks(self, indexes: list[int],
+                    workers: None | int = None) -> dict[int, bytes]:
+        # read sorted chunk indexes, merging runs of neighbours into one read
+        cs = self._hdr.chunk_size
+        chunks = {}
+        i = 0
+        while i < len(indexes):
+            j = i + 1
+            while j < len(indexes) and indexes[j] == indexes[j - 1] + 1:
+                j += 1
+            if indexes[i] <= 0:
+                raise ValueError(f'Requested invalid chunk {indexes[i]}')
+            with self._io_lock:
+                self.fd.seek(self._hdr.chunk_position(indexes[i]))
+                buf = self.fd.read(cs * (j - i))
+            if len(buf) != cs * (j - i):
+                raise ValueError(f'Requested invalid chunk {indexes[j - 1]} '
+                                 '(out of file)')
+            for k in range(i, j):
+                chunks[indexes[k]] = buf[(k - i) * cs:(k - i + 1) * cs]
+            i = j
+        if self._cipher is not None:
+            chunks = self._cipher.decrypt_many(chunks, workers)
+        return chunks
+
+    @tracked()
     def enumerate_file_chunks(self, file: FileHeader
                               ) -> Iterator[tuple[int, FileChunk]]:
+        if self._index is not None and file.offset in self._index.file_chunks:
+            yield from self._index.file_chunks[file.offset]
+            return
         next_chunk = file.offset
         while next_chunk != -1:
             chunk = self._get_chunk(next_chunk)
@@ -171,10 +877,50 @@ class SFSContainer:
             chunk = self._get_chunk(fdco)
             yield FileDataChunk(chunk)
 
+    @tracked()
+    def sync(self, source_dir: str, password: None | bytes = None,
+             compression_level: None | int = 1, checksum: bool = False,
+             delete: bool = True) -> SyncResult:
+        return sync_directory(self, source_dir, password, compression_level,
+                              checksum, delete)
+
+    def verify(self, password: None | bytes = None, decode: bool = False,
+               workers: None | int = None) -> VerifyReport:
+        self.fd.flush()
+        return verify_archive(self.fd, password, decode, workers)
+
+    def clone(self, dest_path: str) -> 'SFSContainer':
+        # Copy the archive without passing it through Python and open the
+        # copy writable, with the free chunks and index already known here
+        with self._alloc_lock, self._io_lock:
+            self.fd.flush()
+            src = self.fd.fileno()
+            size = os.fstat(src).st_size
+            dst = open(dest_path, 'wb+')
+            try:
+                copy_file(src, dst.fileno(), size)
+            except BaseException:
+                dst.close()
+                os.unlink(dest_path)
+                raise
+            empty_chunks = set(self._empty_chunks)
+            last_chunk = self._last_chunk
+            index = self._index
+        dst.seek(0)
+        clone = SFSContainer(dst, cipher=self._cipher)
+        clone._empty_chunks = empty_chunks
+        clone._last_chunk = last_chunk
+        if index is not None:
+            st = os.fstat(dst.fileno())
+            clone._index = dataclasses.replace(
+                index, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        return clone
+
+    @tracked()
     def truncate(self) -> None:
         self._refresh_empty_chunks()
         while (self._last_chunk - 1) in self._empty_chunks:
             self._last_chunk -= 1
             self._empty_chunks.remove(self._last_chunk)
         os.ftruncate(self.fd.fileno(),
-                     self._last_chunk * self._hdr.chunk_size + 280)
+                     self._hdr.chunk_position(self._last_chunk))
@@ -0,0 +1,145 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Counters and timers for the stages of reading and writing archives.
+# Container methods make their Stats current while they run, and the
+# instrumented functions record into whatever Stats is current, so when no
+# container has stats enabled the cost is a context variable lookup.
+
+from contextvars import ContextVar
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Iterator, ParamSpec, TypeVar
+
+
+P = ParamSpec('P')
+R = TypeVar('R')
+
+Hook = Callable[[str, float, int], None]
+
+
+class Stats:
+    def __init__(self, hook: None | Hook = None) -> None:
+        self.hook = hook
+        self._lock = threading.Lock()
+        self._calls: dict[str, int] = {}
+        self._seconds: dict[str, float] = {}
+        self._bytes: dict[str, int] = {}
+
+    def record(self, stage: str, seconds: float, nbytes: int = 0) -> None:
+        with self._lock:
+            self._calls[stage] = self._calls.get(stage, 0) + 1
+            self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+            self._bytes[stage] = self._bytes.get(stage, 0) + nbytes
+        if self.hook is not None:
+            self.hook(stage, seconds, nbytes)
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        # Times are inclusive, aacs_deflate contains its crc16 for example
+        with self._lock:
+            return {stage: {'calls': self._calls[stage],
+                            'seconds': self._seconds[stage],
+                            'bytes': self._bytes[stage]}
+                    for stage in self._calls}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._calls.clear()
+            self._seconds.clear()
+            self._bytes.clear()
+
+
+_current: ContextVar[None | Stats] = ContextVar('sfs_stats', default=None)
+
+
+def _nbytes(args: tuple[Any, ...], result: Any) -> int:
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    for arg in args:
+        if isinstance(arg, (bytes, bytearray, memoryview)):
+            return len(arg)
+    return 0
+
+
+def timed(stage: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    def decorator(func: Callable[P, R]) -> Callable[P, R]:
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            stats = _current.get()
+            if stats is None:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            result = func(*args, **kwargs)
+            stats.record(stage, time.perf_counter() - t0,
+                         _nbytes(args, result))
+            return result
+        return wrapper
+    return decorator
+
+
+def _iter_with(stats: Stats, it: Iterator[R]) -> Iterator[R]:
+    while True:
+        token = _current.set(stats)
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            _current.reset(token)
+        yield item
+
+
+def tracked(stage: None | str = None
+            ) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    # For methods of objects with a stats attribute: make it current while
+    # the method runs, and time the call itself when stage is given
+    def decorator(func: Callable[P, R]) -> Callable[P, R]:
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def gen_wrapper(*args: P.args, **kwargs: P.kwargs) -> Any:
+                stats = getattr(args[0], 'stats')
+                if stats is None:
+                    return func(*args, **kwargs)
+                return _iter_with(stats, func(*args, **kwargs))
+            return gen_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            stats = getattr(args[0], 'stats')
+            if stats is None:
+                return func(*args, **kwargs)
+            token = _current.set(stats)
+            t0 = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _current.reset(token)
+            if stage is not None:
+                stats.record(stage, time.perf_counter() - t0,
+                             _nbytes(args[1:], result))
+            return result
+        return wrapper
+    return decorator
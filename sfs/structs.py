@@ -23,10 +23,52 @@ SOFTWARE.
 """
 
 from dataclasses import dataclass
+import os
 import struct
-from typing import Any
+import time
+from typing import Any, Callable, Generic, TypeVar, overload
 
-from sfs.wrongaes import explode_key, sfs_decrypt, checkxor
+from sfs.wrongaes import explode_key, sfs_decrypt, sfs_encrypt, checkxor
+
+
+HEADER_SIZE = 364
+# chunk 0 starts at the second magic of the header
+CHUNKS_OFFSET = 280
+CHUNK_HEADER_SIZE = 32
+MIN_CHUNK_SIZE = 1024
+
+
+def filetime(ns: int) -> float:
+    # FILETIME, 100ns intervals since 1601, in the same unit as the parsed
+    # headers
+    return (ns // 100 + 116444736000000000) / 1e9
+
+
+def unwrap_key(key: bytes, password_key: bytes) -> bytes:
+    data = bytearray(key)
+    sfs_decrypt(data, password_key)
+    decrypted_key = bytes(data)
+    return explode_key(decrypted_key + b'\x00')
+
+
+def new_key(password: bytes) -> bytes:
+    # a random data key, wrapped with the password
+    data = bytearray(os.urandom(32))
+    sfs_encrypt(data, explode_key(password))
+    return bytes(data)
+
+
+def rewrap_key(key: bytes, old_password: bytes, new_password: bytes) -> bytes:
+    # the data key itself is unchanged, only its wrapping is replaced
+    data = bytearray(key)
+    sfs_decrypt(data, explode_key(old_password))
+    sfs_encrypt(data, explode_key(new_password))
+    return bytes(data)
+
+
+def valid_chunk_size(chunk_size: int) -> bool:
+    return (chunk_size >= MIN_CHUNK_SIZE and
+            chunk_size & (chunk_size - 1) == 0)
 
 
 @dataclass(slots=True, init=False)
@@ -43,25 +85,26 @@ class DirectoryTree:
 
     def __init__(self, data: bytes, rem_entries: int) -> None:
         (self.next_chunk, self.xor, self.c, self.d, self.e, self.f, self.g,
-         self.h) = struct.unpack('<i7I', data[:32])
+         self.h) = struct.unpack('<i7I', data[:CHUNK_HEADER_SIZE])
         self.files = []
 
-        leftover = data[32:]
-        assert checkxor(leftover) == self.xor
+        # the headers keep a reference to the chunk, nothing is copied
+        data = bytes(data)
+        view = memoryview(data)
+        assert checkxor(view[CHUNK_HEADER_SIZE:]) == self.xor
 
+        pos = CHUNK_HEADER_SIZE
         for _ in range(rem_entries):
-            if len(leftover) < 512:
-                assert all(b == 0 for b in leftover)
+            if len(data) - pos < 512:
                 break
+            self.files.append(FileHeader(data, pos))
+            pos += 512
 
-            fileheader = leftover[:512]
-            leftover = leftover[512:]
-            rem_entries -= 1
-
-            fh = FileHeader(fileheader)
-            self.files.append(fh)
+        assert not any(view[pos:])
 
-        assert all(b == 0 for b in leftover)
+    @staticmethod
+    def capacity(chunk_size: int) -> int:
+        return (chunk_size - CHUNK_HEADER_SIZE) // 512
 
     def serialize(self, chunk_size: int) -> bytes:
         data = b''
@@ -91,29 +134,110 @@ class DirectoryTree:
         ]) + ')'
 
 
-@dataclass(slots=True, init=False)
-class FileHeader:
-    offset: int
-    size: int
-    times: tuple[int, int, int]
-    ftype: int
-    parent: int
-    zero: int
-    key: bytes
-    unknown: bytes
-    etype: int
-    filename: str
+T = TypeVar('T')
 
-    def __init__(self, data: bytes) -> None:
-        assert len(data) == 512
-        t = struct.unpack('<i4QIiI32s140sI288s', data)
-        (self.offset, self.size, timea, timeb, timec, self.ftype,
-         self.parent, self.zero, self.key, self.unknown, self.etype,
-         fname) = t
-        self.times = timea/1e9, timeb/1e9, timec/1e9
-        self.filename = fname.decode('ascii').strip('\x00')
+
+class _Field(Generic[T]):
+    # A FileHeader field at a fixed position of its 512 bytes, unpacked from
+    # the buffer on each read until the header is materialized
+
+    def __init__(self, fmt: str, pos: int,
+                 convert: Callable[[tuple[Any, ...]], T]) -> None:
+        self.fmt = fmt
+        self.pos = pos
+        self.convert = convert
+        self.name = ''
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    @overload
+    def __get__(self, obj: None, owner: type) -> '_Field[T]': ...
+
+    @overload
+    def __get__(self, obj: 'FileHeader', owner: type) -> T: ...
+
+    def __get__(self, obj: 'None | FileHeader',
+                owner: type) -> 'T | _Field[T]':
+        if obj is None:
+            return self
+        if obj._fields is not None:
+            value: T = obj._fields[self.name]
+            return value
+        return self.convert(struct.unpack_from(self.fmt, obj._buf,
+                                               obj._pos + self.pos))
+
+    def __set__(self, obj: 'FileHeader', value: T) -> None:
+        obj._materialize()[self.name] = value
+
+
+def _first(t: tuple[Any, ...]) -> Any:
+    return t[0]
+
+
+def _times(t: tuple[Any, ...]) -> tuple[float, float, float]:
+    return t[0] / 1e9, t[1] / 1e9, t[2] / 1e9
+
+
+def _filename(t: tuple[Any, ...]) -> str:
+    name: bytes = t[0]
+    return name.decode('ascii').strip('\x00')
+
+
+class FileHeader:
+    # Parsed headers are views over the chunk they were read from: a field
+    # is decoded when it is read, and all of them are unpacked the first
+    # time one is assigned. Unchanged headers serialize to their own bytes.
+    __slots__ = ('_buf', '_pos', '_fields')
+
+    offset = _Field[int]('<i', 0, _first)
+    size = _Field[int]('<Q', 4, _first)
+    times = _Field[tuple[float, float, float]]('<3Q', 12, _times)
+    ftype = _Field[int]('<I', 36, _first)
+    parent = _Field[int]('<i', 40, _first)
+    zero = _Field[int]('<I', 44, _first)
+    key = _Field[bytes]('32s', 48, _first)
+    unknown = _Field[bytes]('140s', 80, _first)
+    etype = _Field[int]('<I', 220, _first)
+    filename = _Field[str]('288s', 224, _filename)
+
+    FIELDS = ('offset', 'size', 'times', 'ftype', 'parent', 'zero', 'key',
+              'unknown', 'etype', 'filename')
+
+    def __init__(self, data: bytes, pos: int = 0) -> None:
+        # the header is data[pos:pos + 512]
+        assert len(data) >= pos + 512
+        self._buf = data
+        self._pos = pos
+        self._fields: None | dict[str, Any] = None
         assert self.zero == 0
 
+    def _materialize(self) -> dict[str, Any]:
+        if self._fields is None:
+            self._fields = {name: getattr(self, name)
+                            for name in self.FIELDS}
+        return self._fields
+
+    def __reduce__(self) -> tuple[type['FileHeader'], tuple[bytes]]:
+        # the buffer may be a whole chunk
+        return FileHeader, (self.serialize(),)
+
+    @classmethod
+    def new(cls, filename: str, parent: int = -1, directory: bool = False,
+            times: None | tuple[float, float, float] = None
+            ) -> 'FileHeader':
+        fh = cls(b'\x00' * 512)
+        fh.filename = filename
+        fh.offset = -1
+        fh.parent = parent
+        fh.ftype = 16 if directory else 32
+        fh.etype = 1 if directory else 0
+        if times is None:
+            now = filetime(time.time_ns())
+            times = now, now, now
+        fh.times = times
+        return fh
+
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, FileHeader):
             return False
@@ -145,6 +269,8 @@ class FileHeader:
         ]) + ')'
 
     def serialize(self) -> bytes:
+        if self._fields is None:
+            return self._buf[self._pos:self._pos + 512]
         fname = self.filename.encode('ascii')
         fname += b'\x00' * (288 - len(fname))
         timea, timeb, timec = [round(1e9 * i) for i in self.times]
@@ -155,11 +281,41 @@ class FileHeader:
         assert len(data) == 512
         return data
 
+    @property
+    def encrypted(self) -> bool:
+        return self.key != b'\x00' * 32
+
     def decrypt_key(self, password: bytes) -> bytes:
-        data = bytearray(self.key)
-        sfs_decrypt(data, explode_key(password))
-        decrypted_key = bytes(data)
-        return explode_key(decrypted_key + b'\x00')
+        return self.unwrap_key(explode_key(password))
+
+    def unwrap_key(self, password_key: bytes) -> bytes:
+        return unwrap_key(self.key, password_key)
+
+    def generate_key(self, password: bytes) -> None:
+        self.key = new_key(password)
+        self.etype |= 0x10000
+
+    def rekey(self, old_password: bytes, new_password: bytes) -> None:
+        self.key = rewrap_key(self.key, old_password, new_password)
+
+
+def entry_paths(entries: list[FileHeader]) -> list[str]:
+    # Full path of each entry, following the parents up to the root. A
+    # parent out of range or already visited ends the path, so a damaged
+    # tree still gives a path for every entry.
+    paths = []
+    for f in entries:
+        path = f.filename
+        parent = f.parent
+        seen = set()
+        while parent != -1 and 0 <= parent < len(entries):
+            if parent in seen:
+                break
+            seen.add(parent)
+            path = entries[parent].filename + '/' + path
+            parent = entries[parent].parent
+        paths.append(path)
+    return paths
 
 
 @dataclass(slots=True, init=False)
@@ -179,13 +335,30 @@ class FileChunk:
         assert len(data) % 4 == 0
         self.dchunks = []
         (self.next_chunk, self.i, self.j, self.k, self.l, self.m, self.n,
-         self.o) = struct.unpack('<iIIIIIII', data[:32])
-        data = data[32:]
+         self.o) = struct.unpack('<iIIIIIII', data[:CHUNK_HEADER_SIZE])
+        data = data[CHUNK_HEADER_SIZE:]
         for i in range(0, len(data), 4):
             fdco, = struct.unpack('<i', data[i:i+4])
             if fdco > 0:
                 self.dchunks.append(fdco)
 
+    @classmethod
+    def empty(cls, chunk_size: int) -> 'FileChunk':
+        return cls(struct.pack('<iIIIIIII', -1, 0, 5, 0, 0, 0, 0, 0) +
+                   b'\x00' * (chunk_size - CHUNK_HEADER_SIZE))
+
+    @staticmethod
+    def capacity(chunk_size: int) -> int:
+        return (chunk_size - CHUNK_HEADER_SIZE) // 4
+
+    def serialize(self, chunk_size: int) -> bytes:
+        assert len(self.dchunks) <= FileChunk.capacity(chunk_size)
+        data = struct.pack('<iIIIIIII', self.next_chunk, self.i, self.j,
+                           self.k, self.l, self.m, self.n, self.o)
+        data += struct.pack(f'<{len(self.dchunks)}i', *self.dchunks)
+        data += b'\x00' * (chunk_size - len(data))
+        return data
+
     def __repr__(self) -> str:
         return 'FileChunk(' + ', '.join([
             repr(self.next_chunk),
@@ -209,10 +382,10 @@ class FileDataChunk:
     data: bytes
 
     def __init__(self, data: bytes) -> None:
-        assert len(data) > 32
-        self.data = data[32:]
+        assert len(data) > CHUNK_HEADER_SIZE
+        self.data = data[CHUNK_HEADER_SIZE:]
         self.q, self.xor, self.flags, self.unknown = struct.unpack(
-            '<iII20s', data[:32])
+            '<iII20s', data[:CHUNK_HEADER_SIZE])
         assert checkxor(self.data) == self.xor
 
     def __repr__(self) -> str:
@@ -248,7 +421,7 @@ class Header:
     key: bytes
 
     def __init__(self, data: bytes) -> None:
-        assert len(data) == 364
+        assert len(data) == HEADER_SIZE
 
         t = struct.unpack('<8s272s8sIIIIIIIIIII32s', data)
         (magic, self.unknown, magic2, self.csc, self.oof, self.chunk_size,
@@ -257,3 +430,26 @@ class Header:
 
         assert magic == b'AAMVHFSS'
         assert magic2 == b'AASFSSGN'
+
+    @property
+    def encrypted(self) -> bool:
+        return self.key != b'\x00' * 32
+
+    def decrypt_key(self, password: bytes) -> bytes:
+        return unwrap_key(self.key, explode_key(password))
+
+    def generate_key(self, password: bytes) -> None:
+        self.key = new_key(password)
+
+    def rekey(self, old_password: bytes, new_password: bytes) -> None:
+        self.key = rewrap_key(self.key, old_password, new_password)
+
+    def chunk_position(self, c: int) -> int:
+        return CHUNKS_OFFSET + c * self.chunk_size
+
+    def serialize(self) -> bytes:
+        return struct.pack('<8s272s8sIIIIIIIIIII32s', b'AAMVHFSS',
+                           self.unknown, b'AASFSSGN', self.csc, self.oof,
+                           self.chunk_size, self.a, self.b, self.c, self.d,
+                           self.e, self.tree_offset, self.n_entr,
+                           self.n_chunks, self.key)
@@ -0,0 +1,189 @@
+"""
+MIT License
+
+Copyright (c) 2024 Enrico Pozzobon <enrico@epozzobon.it>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Mirroring of a directory into an archive. Members are compared with the
+# files by modification time, and by size when they are stored uncompressed,
+# so unchanged members are never read. The changes are then applied
+# together: the chunks of replaced and deleted members are freed, the new
+# ones are allocated in one go and each tree chunk is written at most once.
+
+from dataclasses import dataclass, field
+import os
+from typing import TYPE_CHECKING
+
+from sfs.builder import _encode_member
+from sfs.structs import FileChunk, FileHeader, filetime
+
+if TYPE_CHECKING:
+    from sfs.sfs import SFSContainer
+
+
+@dataclass
+class SyncResult:
+    added: list[str] = field(default_factory=list)
+    replaced: list[str] = field(default_factory=list)
+    deleted: list[str] = field(default_factory=list)
+    # same contents, only the times were updated
+    touched: list[str] = field(default_factory=list)
+    unchanged: int = 0
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.replaced or self.deleted or
+                    self.touched)
+
+
+def _scan(source_dir: str) -> dict[str, tuple[str, os.stat_result, bool]]:
+    # parents are listed before their contents
+    source = {}
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        rel = os.path.relpath(root, source_dir).replace(os.sep, '/')
+        prefix = '' if rel == '.' else rel + '/'
+        for names, is_dir in ((dirs, True), (sorted(files), False)):
+            for name in names:
+                full = os.path.join(root, name)
+                source[prefix + name] = full, os.stat(full), is_dir
+    return source
+
+
+def _unchanged(f: FileHeader, st: os.stat_result,
+               compression_level: None | int) -> bool:
+    if abs(f.times[2] - filetime(st.st_mtime_ns)) > 1e-6:
+        return False
+    return compression_level is not None or f.size == st.st_size
+
+
+def sync_directory(sfs: 'SFSContainer', source_dir: str,
+                   password: None | bytes = None,
+                   compression_level: None | int = 1,
+                   checksum: bool = False,
+                   delete: bool = True) -> SyncResult:
+    result = SyncResult()
+    source = _scan(source_dir)
+    walked = list(sfs.walk())
+    entries = [f for _, f in walked]
+    index = {path: i for i, (path, _) in enumerate(walked)}
+    if sfs._last_chunk == -1:
+        sfs._refresh_empty_chunks()
+
+    removed = set()
+    for path, i in index.items():
+        if path not in source:
+            if delete:
+                removed.add(i)
+                result.deleted.append(path)
+        elif bool(entries[i].ftype & 16) != source[path][2]:
+            removed.add(i)
+    # the contents of a removed directory go with it
+    gone = [walked[i][0] + '/' for i in removed]
+    for path, i in index.items():
+        if i not in removed and path.startswith(tuple(gone)):
+            removed.add(i)
+            result.deleted.append(path)
+
+    pending: list[tuple[FileHeader, bytes]] = []
+    added: list[tuple[str, FileHeader]] = []
+    replaced: list[FileHeader] = []
+    for path, (full, st, is_dir) in source.items():
+        m = filetime(st.st_mtime_ns)
+        i = index.get(path, -1)
+        if i == -1 or i in removed:
+            f = FileHeader.new(path.rpartition('/')[2], directory=is_dir,
+                               times=(m, m, m))
+            added.append((path, f))
+            result.added.append(path)
+            if not is_dir:
+                if password is not None:
+                    f.generate_key(password)
+                with open(full, 'rb') as fd:
+                    pending.append((f, fd.read()))
+            continue
+
+        f = entries[i]
+        if is_dir or _unchanged(f, st, compression_level):
+            result.unchanged += 1
+            continue
+        if f.encrypted and password is None:
+            raise ValueError(f'{path} is encrypted, a password is needed')
+        with open(full, 'rb') as fd:
+            data = fd.read()
+        if checksum and sfs.read_file(
+                f, password if f.encrypted else None) == data:
+            result.touched.append(path)
+        else:
+            replaced.append(f)
+            pending.append((f, data))
+            result.replaced.append(path)
+        f.times = f.times[0], m, m
+
+    if not result.changed:
+        return result
+
+    # nothing is freed until every member has been checked, so an abort
+    # above leaves the free chunks as they were
+    for f in replaced + [entries[i] for i in removed]:
+        sfs._free_file_chunks(f)
+
+    cs = sfs._hdr.chunk_size
+    fc_capacity = FileChunk.capacity(cs)
+    encoded = [_encode_member((f, data, password if f.encrypted else None,
+                               compression_level, cs))
+               for f, data in pending]
+    total = sum(-(-len(chunks) // fc_capacity) + len(chunks)
+                for _, chunks in encoded)
+    offsets = sfs._allocate_chunks(total)
+    for (f, _), (size, chunks) in zip(pending, encoded):
+        f.size = size
+        f.offset = -1
+        if not chunks:
+            continue
+        n_fc = -(-len(chunks) // fc_capacity)
+        fcs, offsets = offsets[:n_fc], offsets[n_fc:]
+        dchunks, offsets = offsets[:len(chunks)], offsets[len(chunks):]
+        for c, chunk in zip(dchunks, chunks):
+            sfs._put_chunk(c, chunk)
+        f.offset = sfs._put_file_chunks(fcs, dchunks)
+
+    new_index: dict[int, int] = {}
+    new_entries: list[FileHeader] = []
+    for i, f in enumerate(entries):
+        if i not in removed:
+            new_index[i] = len(new_entries)
+            new_entries.append(f)
+    paths = {}
+    for i, j in new_index.items():
+        f = new_entries[j]
+        if f.parent != -1:
+            f.parent = new_index[f.parent]
+        paths[walked[i][0]] = j
+    for path, f in added:
+        dirname = path.rpartition('/')[0]
+        f.parent = paths[dirname] if dirname else -1
+        paths[path] = len(new_entries)
+        new_entries.append(f)
+
+    sfs._put_entries(new_entries)
+    sfs._put_free_map()
+    return result
@@ -22,29 +22,98 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import errno
+import os
 import struct
+from typing import Callable
 import zlib
 
-from sfs.wrongaes import checkxor, sfs_encrypt, crc16
+from sfs.stats import timed
+from sfs.structs import CHUNK_HEADER_SIZE
+from sfs.wrongaes import checkxor, sfs_encrypt, crc16, crc16_combine
 
+try:
+    from sfs.npaes import sfs_encrypt_chunks
+except ImportError:
+    sfs_encrypt_chunks = None  # type: ignore[assignment]
 
-def aacs_inflate(data: bytes) -> bytes:
+
+AACS_MAX_LEVEL = 9
+AACS_DATA_OFFSET = 0x90
+
+# Bytes handed to the kernel per copy call, and errors meaning the copy
+# call is not supported between these two files
+COPY_BLOCK = 1 << 30
+COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSUP,
+                    errno.EOPNOTSUPP, errno.EBADF)
+
+# Leading bytes of formats whose payload is already compressed, deflating
+# these again costs time and saves next to nothing
+COMPRESSED_MAGICS = (
+    b'\x89PNG\r\n\x1a\n',  # PNG
+    b'\xff\xd8\xff',  # JPEG
+    b'GIF87a', b'GIF89a',
+    b'PK\x03\x04',  # ZIP
+    b'\x1f\x8b',  # gzip
+    b'BZh',  # bzip2
+    b'\xfd7zXZ\x00',  # xz
+    b'7z\xbc\xaf\x27\x1c',
+    b'AACS',
+)
+
+
+def aacs_header(data: bytes) -> tuple[int, int, int, int]:
+    # compression level, deflated size, inflated size and crc16 of an AACS
+    # member, the deflated stream follows at AACS_DATA_OFFSET
     assert data[:4] == b'AACS'
     compression_level, = struct.unpack('<I', data[20:24])
-
-    pieces = struct.unpack('<IIII', data[0x80:0x90])
+    pieces = struct.unpack('<IIII', data[0x80:AACS_DATA_OFFSET])
     avail_in, inflated_size, crc, p3 = pieces
+    assert inflated_size == 0 or avail_in == p3 - 16
+    return compression_level, avail_in, inflated_size, crc
+
+
+def plausible_prefix(data: bytes, size: int) -> bool:
+    # Whether data can be the decrypted start of a member of size bytes, to
+    # tell a right key from a wrong one without decoding the whole member:
+    # AACS with a known level, zero padding, a known format or plain text
+    if data[:4] == b'AACS':
+        return int.from_bytes(data[20:24], 'little') <= AACS_MAX_LEVEL
+    padding = len(data) - size
+    if padding > 0 and any(data[size:]):
+        return False
+    if padding >= 8:
+        return True
+    data = data[:size]
+    if any(data.startswith(m) for m in COMPRESSED_MAGICS if len(m) >= 3):
+        return True
+    for cut in range(4):
+        # the prefix may end inside a multibyte character
+        try:
+            text = data[:len(data) - cut].decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        return bool(text) and all(c.isprintable() or c in '\t\r\n'
+                                  for c in text)
+    return False
+
+
+@timed('aacs_inflate')
+def aacs_inflate(data: bytes,
+                 inflate: Callable[[bytes], bytes] = zlib.decompress
+                 ) -> bytes:
+    compression_level, avail_in, inflated_size, crc = aacs_header(data)
     if inflated_size == 0:
         return b''
-    deflated = data[0x90:0x90 + avail_in]
+    deflated = data[AACS_DATA_OFFSET:AACS_DATA_OFFSET + avail_in]
     assert len(deflated) == avail_in
-    assert avail_in == p3 - 16
-    assert all(b == 0 for b in data[0x90 + avail_in:])
+    assert all(b == 0 for b in data[AACS_DATA_OFFSET + avail_in:])
 
     if compression_level == 0:
         data = deflated
-    if compression_level in [1, 2]:
-        data = zlib.decompress(deflated)
+    elif 1 <= compression_level <= AACS_MAX_LEVEL:
+        data = inflate(deflated)
     else:
         raise ValueError(f"Unknown compression level {compression_level}")
 
@@ -53,23 +122,111 @@ def aacs_inflate(data: bytes) -> bytes:
     return data
 
 
-def aacs_deflate(data: bytes, compression_level: int) -> bytes:
+def _aacs_wrap(deflated: bytes, inflated_size: int, crc: int,
+               compression_level: int) -> bytes:
     hdr = struct.pack('<4sIIIII', b'AACS', 0x80000, 0, 1,
                       0x40000000, compression_level)
     hdr += b'\x00' * 0x68
-    if compression_level == 1:
-        deflated = zlib.compress(data, level=compression_level)
-    else:
-        # TODO: allow setting compression level
-        raise NotImplementedError()
-
     avail_in = len(deflated)
-    inflated_size = len(data)
-    crc = crc16(data)
     sizes = struct.pack('<IIII', avail_in, inflated_size,
                         crc, avail_in + 16)
-    data = hdr + sizes + deflated
-    return data
+    return hdr + sizes + deflated
+
+
+@timed('aacs_deflate')
+def aacs_deflate(data: bytes, compression_level: int) -> bytes:
+    if not 0 <= compression_level <= AACS_MAX_LEVEL:
+        raise ValueError(f"Unknown compression level {compression_level}")
+    if compression_level == 0:
+        deflated = data
+    else:
+        deflated = zlib.compress(data, level=compression_level)
+    return _aacs_wrap(deflated, len(data), crc16(data), compression_level)
+
+
+def _deflate_block(job: tuple[bytes, bytes, int, bool]) -> tuple[bytes, int]:
+    block, zdict, compression_level, last = job
+    crc = crc16(block)
+    if compression_level == 0:
+        return b'', crc
+    if zdict:
+        c = zlib.compressobj(compression_level, zlib.DEFLATED, -15,
+                             zdict=zdict)
+    else:
+        c = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+    deflated = c.compress(block)
+    deflated += c.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+    return deflated, crc
+
+
+def _zlib_header(compression_level: int) -> bytes:
+    if compression_level < 2:
+        flevel = 0
+    elif compression_level < 6:
+        flevel = 1
+    elif compression_level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    cmf = 0x78
+    flg = flevel << 6
+    flg += 31 - (cmf * 256 + flg) % 31
+    return bytes([cmf, flg])
+
+
+@timed('aacs_deflate_parallel')
+def aacs_deflate_parallel(data: bytes, compression_level: int,
+                          workers: None | int = None,
+                          block_size: int = 0x20000) -> bytes:
+    # pigz-style: each block is deflated on its own, primed with the 32KiB
+    # of input before it, and ends on a full flush so the raw deflate
+    # streams can be concatenated into a single zlib stream
+    if not 0 <= compression_level <= AACS_MAX_LEVEL:
+        raise ValueError(f"Unknown compression level {compression_level}")
+    if len(data) <= block_size:
+        return aacs_deflate(data, compression_level)
+
+    offsets = range(0, len(data), block_size)
+    jobs = [(data[off:off + block_size], data[max(0, off - 0x8000):off],
+             compression_level, off + block_size >= len(data))
+            for off in offsets]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_deflate_block, jobs))
+
+    crc = 0
+    for (block, _, _, _), (_, block_crc) in zip(jobs, results):
+        crc = crc16_combine(crc, block_crc, len(block))
+
+    if compression_level == 0:
+        deflated = data
+    else:
+        deflated = b''.join([
+            _zlib_header(compression_level),
+            *[d for d, _ in results],
+            struct.pack('>I', zlib.adler32(data)),
+        ])
+    return _aacs_wrap(deflated, len(data), crc, compression_level)
+
+
+def choose_compression_level(data: bytes, compression_level: int,
+                             sample_size: int = 0x4000,
+                             min_saving: float = 0.1) -> int:
+    # Store (level 0) data that is already compressed, either recognized by
+    # its magic or because deflating a few samples of it barely shrinks them
+    if compression_level == 0 or data.startswith(COMPRESSED_MAGICS):
+        return 0
+    if len(data) <= 3 * sample_size:
+        sample = data
+    else:
+        mid = (len(data) - sample_size) // 2
+        sample = (data[:sample_size] + data[mid:mid + sample_size] +
+                  data[-sample_size:])
+    if not sample:
+        return compression_level
+    deflated = zlib.compress(sample, level=1)
+    if len(deflated) > len(sample) * (1 - min_saving):
+        return 0
+    return compression_level
 
 
 def split_into_chunks(data: bytes, chunk_data_size: int) -> list[bytes]:
@@ -87,12 +244,19 @@ def split_into_chunks(data: bytes, chunk_data_size: int) -> list[bytes]:
 def make_chunks(data: bytes, chunk_size: int,
                 key: None | bytes = None) -> list[bytes]:
     # split data into chunks, leaving 32 bytes for header
-    chunk_data_size = chunk_size - 32
+    chunk_data_size = chunk_size - CHUNK_HEADER_SIZE
     chunks = split_into_chunks(data, chunk_data_size)
 
+    # encrypt all the chunks together when NumPy is available
+    vectorized = (key is not None and sfs_encrypt_chunks is not None and
+                  len(chunks) > 1)
+    if vectorized:
+        assert key is not None and sfs_encrypt_chunks is not None
+        chunks = sfs_encrypt_chunks(chunks, key)
+
     # put header on each chunk
     for i, chunk_data in enumerate(chunks):
-        if key is not None:
+        if key is not None and not vectorized:
             datab = bytearray(chunk_data)
             sfs_encrypt(datab, key)
             chunk_data = bytes(datab)
@@ -102,3 +266,68 @@ def make_chunks(data: bytes, chunk_size: int,
         chunk_hdr = struct.pack("<iII20s", -1, xor, flags, b"\x00" * 20)
         chunks[i] = chunk_hdr + chunk_data
     return chunks
+
+
+def free_map_capacity(chunk_size: int) -> int:
+    # number of chunks, counting the header chunk 0, the free map describes
+    return (chunk_size - CHUNK_HEADER_SIZE) * 8 + 1
+
+
+def make_free_map(free: set[int], n_chunks: int,
+                  chunk_size: int) -> tuple[bytes, bytes]:
+    # Chunks 1 and 2 hold a two level bitmap of free chunks: bit i of the
+    # first is set when chunk i + 1 is free, bit i of the second when byte
+    # i of the first is all free.
+    body_size = chunk_size - CHUNK_HEADER_SIZE
+    if n_chunks > free_map_capacity(chunk_size):
+        raise NotImplementedError('Too many chunks for the free map')
+    bitmap = bytearray(b'\xff' * body_size)
+    for c in range(1, n_chunks):
+        if c not in free:
+            bitmap[(c - 1) // 8] &= ~(1 << ((c - 1) % 8)) & 0xff
+    summary = bytearray(b'\xff' * body_size)
+    for i, b in enumerate(bitmap):
+        if b != 0xff:
+            summary[i // 8] &= ~(1 << (i % 8)) & 0xff
+    return bytes(bitmap), bytes(summary)
+
+
+def make_map_chunk(kind: int, body: bytes) -> bytes:
+    return struct.pack('<iII20s', 0, checkxor(body), kind,
+                       b'\x00' * 20) + body
+
+
+def copy_file(src: int, dst: int, size: int) -> None:
+    # copy_file_range shares the extents on filesystems with reflinks and
+    # copies inside the kernel elsewhere, sendfile is the fallback for
+    # older kernels and cross-filesystem copies, plain reads the last one
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                n = os.copy_file_range(src, dst, min(COPY_BLOCK,
+                                                     size - offset),
+                                       offset, offset)
+                if n == 0:
+                    break
+                offset += n
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+    if offset < size and hasattr(os, 'sendfile'):
+        os.lseek(dst, offset, os.SEEK_SET)
+        try:
+            while offset < size:
+                n = os.sendfile(dst, src, offset,
+                                min(COPY_BLOCK, size - offset))
+                if n == 0:
+                    break
+                offset += n
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED:
+                raise
+    while offset < size:
+        data = os.pread(src, min(1 << 20, size - offset), offset)
+        if not data:
+            raise OSError(errno.EIO, 'Archive shrank while copying')
+        offset += os.pwrite(dst, data, offset)
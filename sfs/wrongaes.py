@@ -25,6 +25,7 @@ SOFTWARE.
 import struct
 from typing import Callable
 from sfs.aes import r_con as RCON, s_box as SBOX, AES
+from sfs.stats import timed
 
 
 def rot_word(w: int) -> int:
@@ -63,6 +64,7 @@ class WrongAES(AES):
         ]
 
 
+@timed('sfs_encrypt')
 def sfs_encrypt(data: bytearray, key: bytes) -> None:
     cipher = WrongAES(key)
     iv = cipher.encrypt_block(b"\xff" * 16)
@@ -73,6 +75,7 @@ def sfs_encrypt(data: bytearray, key: bytes) -> None:
         data[j*16:j*16 + 16] = ct
 
 
+@timed('sfs_decrypt')
 def sfs_decrypt(data: bytearray, key: bytes) -> None:
     cipher = WrongAES(key)
     iv = cipher.encrypt_block(b'\xff' * 16)
@@ -83,6 +86,7 @@ def sfs_decrypt(data: bytearray, key: bytes) -> None:
         data[i*16:i*16+16] = pt
 
 
+@timed('crc16')
 def crc16(src: bytes, start: int = 0) -> int:
     lut = [
         0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280, 0xC241,
@@ -123,6 +127,44 @@ def crc16(src: bytes, start: int = 0) -> int:
     return start
 
 
+def _gf2_times(mat: list[int], vec: int) -> int:
+    s = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+
+def crc16_combine(crc1: int, crc2: int, len2: int) -> int:
+    # crc16(a + b) from crc16(a), crc16(b) and len(b), in O(log(len(b)))
+    # by squaring the operator that feeds a zero bit into the register, the
+    # same way zlib combines its CRC-32s
+    if len2 <= 0:
+        return crc1
+    odd = [0xA001] + [1 << n for n in range(15)]
+    even = [_gf2_times(odd, v) for v in odd]
+    odd = [_gf2_times(even, v) for v in even]
+    while True:
+        # apply the operator for the next power of two zero bytes
+        even = [_gf2_times(odd, v) for v in odd]
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+        odd = [_gf2_times(even, v) for v in even]
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+    return crc1 ^ crc2
+
+
+@timed('explode_key')
 def explode_key(password: bytes) -> bytes:
     pb = bytes.fromhex('''
         01 23 45 67 89 AB CD EF FE DC BA 98 76 54 32 10
@@ -200,8 +242,14 @@ def xorpad(a: bytes, b: bytes) -> bytes:
     return bytes(i ^ j for i, j in zip(a, b))
 
 
-def checkxor(data: bytes) -> int:
-    x = 0
-    for b in struct.unpack(f'{len(data)//4}I', data):
-        x ^= b
+@timed('checkxor')
+def checkxor(data: bytes | memoryview) -> int:
+    # xor of all the little endian 32 bit words, computed by folding the
+    # whole buffer as one integer
+    x = int.from_bytes(data, 'little')
+    bits = len(data) * 8
+    while bits > 32:
+        half = (bits // 64 + bits % 64 // 32) * 32
+        x = (x >> half) ^ (x & ((1 << half) - 1))
+        bits = half
     return x
@@ -1,6 +1,14 @@
-from sfs import SFSContainer
+from sfs import SFSContainer, SFSBuilder
+from sfs.cli import main
+from sfs.index import open_archive
+from sfs.structs import FileHeader, entry_paths
+from sfs.utils import free_map_capacity
+from sfs.wrongaes import checkxor
 import os.path
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+import pytest
 
 
 def asset(filename: str) -> str:
@@ -95,7 +103,11 @@ def test_sfs_replace_file() -> None:
                     sfs.write_file(f, layout, b'45654hKL5-GFD1326lvmaQQ')
     with open(pat1, 'rb') as fd:
         d = hashlib.md5(fd.read(), usedforsecurity=False).digest()
-    assert d.hex() == 'cd486e05a9a8a319ad67fd5dd63f15c7'
+        fd.seek(0)
+        sfs = SFSContainer(fd)
+        f = sfs.find_file('LayoutDef.lyd')
+        assert sfs.read_file(f, b'45654hKL5-GFD1326lvmaQQ') == layout
+    assert d.hex() == 'b840b291e02e4b677582a19f0971ef20'
     os.unlink(pat1)
 
 
@@ -160,3 +172,697 @@ def test_sfs_extract() -> None:
             os.makedirs('outputs', exist_ok=True)
             with open('outputs/' + f.filename, 'wb') as fd:
                 fd.write(data)
+
+
+def test_sfs_replace_file_adaptive() -> None:
+    pat0 = asset('directory_example.sfs')
+    pat1 = asset('directory_example_adaptive.sfs')
+    with open(pat0, 'rb') as src:
+        with open(pat1, 'wb') as dst:
+            dst.write(src.read())
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        for dt in sfs.get_tree():
+            for f in dt.files:
+                if f.filename == 'ce.png':
+                    image = sfs.read_file(f)
+                    sfs.write_file(f, image, adaptive=True)
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        for dt in sfs.get_tree():
+            for f in dt.files:
+                if f.filename == 'ce.png':
+                    assert f.size == len(image) + 0x90
+                    assert sfs.read_file(f) == image
+    os.unlink(pat1)
+
+
+def test_sfs_replace_file_grow(tmp_path: str) -> None:
+    # storing the PNG takes one chunk more than its deflated original
+    pat1 = os.path.join(tmp_path, 'ugly_label_grow.stc')
+    password = b'45654hKL5-GFD1326lvmaQQ'
+    with open(asset('ugly_label.stc'), 'rb') as src:
+        with open(pat1, 'wb') as dst:
+            dst.write(src.read())
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        f = sfs.find_file('PreviewImage.png')
+        image = sfs.read_file(f, password)
+        n_chunks = len(sfs._get_data_chunk_indexes(f))
+        sfs.write_file(f, image, password, adaptive=True)
+        assert len(sfs._get_data_chunk_indexes(f)) == n_chunks + 1
+        assert sfs.verify(password, decode=True, workers=1).ok
+        f = sfs.find_file('PreviewImage.png')
+        assert f.size == len(image) + 0x90
+        assert sfs.read_file(f, password) == image
+
+        sfs.write_file(f, image[:1000], password)
+        assert len(sfs._get_data_chunk_indexes(f)) == 1
+        report = sfs.verify(password, decode=True, workers=1)
+        assert report.ok and not report.leaked
+        assert sfs.read_file(sfs.find_file('PreviewImage.png'),
+                             password) == image[:1000]
+
+    # past the chunks the free map has room for, only those are mapped
+    pat2 = os.path.join(tmp_path, 'large.sfs')
+    builder = SFSBuilder(chunk_size=1024)
+    builder.add_file('big.bin', b'', None, None)
+    with open(pat2, 'wb') as fd:
+        builder.write(fd, workers=1)
+    data = os.urandom(1000 * 8000)
+    with open(pat2, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        sfs.write_file(sfs.find_file('big.bin'), data, None, None)
+        assert sfs._last_chunk > free_map_capacity(1024)
+        assert sfs.verify().ok
+        assert sfs.read_file(sfs.find_file('big.bin')) == data
+
+
+def test_sfs_rekey() -> None:
+    pat0 = asset('ugly_label.stc')
+    pat1 = asset('ugly_label_rekey.stc')
+    HASHES = {
+        'LayoutProps.def': '6658291332cd5ac4cdd4c6d4859d8641',
+        'Devices.def': '2ba452b8c0ef3def30fed915e93ec689',
+    }
+    with open(pat0, 'rb') as src:
+        with open(pat1, 'wb') as dst:
+            dst.write(src.read())
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        with pytest.raises(ValueError):
+            sfs.rekey(b'WRONG', b'new password')
+        sfs.rekey(b'45654hKL5-GFD1326lvmaQQ', b'new password')
+    with open(pat0, 'rb') as fd0, open(pat1, 'rb') as fd1:
+        # only the directory tree chunks may change
+        old, new = fd0.read(), fd1.read()
+        assert len(old) == len(new)
+        for c in range(len(old) // 4096):
+            if c not in (4, 35):
+                pos = 280 + c * 4096
+                assert old[pos:pos + 4096] == new[pos:pos + 4096]
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        for dt in sfs.get_tree():
+            for f in dt.files:
+                if f.filename in HASHES:
+                    data = sfs.read_file(f, b'new password')
+                    d = hashlib.md5(data, usedforsecurity=False).digest()
+                    assert d.hex() == HASHES[f.filename]
+    os.unlink(pat1)
+
+
+def test_sfs_copy_member() -> None:
+    pat0 = asset('encrypted_example.sfs')
+    pat1 = asset('encrypted_example_copy_member.sfs')
+    pat2 = asset('ugly_label.stc')
+    HASHES = {
+        'Layout.ini': 'd41d8cd98f00b204e9800998ecf8427e',
+        'LayoutProps.def': '6658291332cd5ac4cdd4c6d4859d8641',
+        'UserSettings.def': 'a9061dbdc676c0f425ee9e4f3bd86bb9',
+        'Devices.def': '2ba452b8c0ef3def30fed915e93ec689',
+        'History.xml': '0a4b51b1423ee3e6492a387b366eefab',
+        'Infos.txt': 'd41d8cd98f00b204e9800998ecf8427e',
+        'small.txt': '0b2b084a372b384bc1db6f537a382dbd',
+    }
+    with open(pat0, 'rb') as src:
+        with open(pat1, 'wb') as dst:
+            dst.write(src.read())
+    with open(pat1, 'rb+') as fd, open(pat2, 'rb') as fd2:
+        sfs = SFSContainer(fd)
+        label = SFSContainer(fd2)
+        for name in HASHES:
+            if name != 'small.txt':
+                sfs.copy_member(label, name, b'45654hKL5-GFD1326lvmaQQ',
+                                b'lol')
+        # replacing an existing member keeps the number of entries
+        sfs.copy_member(label, 'Devices.def', b'45654hKL5-GFD1326lvmaQQ',
+                        b'lol')
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        assert len(list(sfs.get_tree())) == 2
+        assert len(sfs.get_entries()) == 9
+        for path, f in sfs.walk():
+            if path in HASHES:
+                data = sfs.read_file(f, b'lol')
+                d = hashlib.md5(data, usedforsecurity=False).digest()
+                assert d.hex() == HASHES[path]
+    os.unlink(pat1)
+
+
+def test_sfs_build() -> None:
+    pat1 = asset('built_example.sfs')
+    with open(asset('LayoutDef.lyd'), 'rb') as fd:
+        layout = fd.read()
+    big = bytes(range(256)) * 16200
+    builder = SFSBuilder()
+    builder.add_file('LayoutDef.lyd', layout, b'lol')
+    builder.add_file('directory/subdirectory/big.bin', big, None, None)
+    builder.add_directory('emptydir')
+    for i in range(6):
+        builder.add_file(f'directory/file{i}.txt', b'x' * i, b'lol', 9)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=2)
+
+    expected = {
+        'LayoutDef.lyd': layout,
+        'directory': b'',
+        'directory/subdirectory': b'',
+        'directory/subdirectory/big.bin': big,
+        'emptydir': b'',
+        **{f'directory/file{i}.txt': b'x' * i for i in range(6)},
+    }
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        assert len(list(sfs.get_tree())) == 2
+        for path, f in sfs.walk():
+            password = b'lol' if f.encrypted else None
+            assert sfs.read_file(f, password) == expected.pop(path)
+        assert not expected
+        # no gaps were left in the layout
+        size = os.path.getsize(pat1)
+        sfs.truncate()
+        assert os.path.getsize(pat1) == size
+        assert sfs._empty_chunks == set()
+    os.unlink(pat1)
+
+
+def test_sfs_build_large(tmp_path: str) -> None:
+    # more chunks than the free map has room for
+    pat1 = os.path.join(tmp_path, 'large.sfs')
+    big = os.urandom(992 * 8000)
+    builder = SFSBuilder(chunk_size=1024)
+    builder.add_file('big.bin', big, None, None)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        assert sfs._hdr.n_chunks > free_map_capacity(1024)
+        report = sfs.verify()
+        assert report.ok and not report.leaked
+        assert sfs.read_file(sfs.find_file('big.bin')) == big
+
+
+@pytest.mark.parametrize('chunk_size', [1024, 16384])
+def test_sfs_chunk_sizes(chunk_size: int) -> None:
+    pat1 = asset(f'chunk_size_{chunk_size}.sfs')
+    big = bytes(range(256)) * 1000
+    builder = SFSBuilder(chunk_size)
+    builder.add_file('big.bin', big, None, None)
+    builder.add_file('dir/small.txt', b'hello', b'lol')
+    for i in range(10):
+        builder.add_directory(f'dir/sub{i}')
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        assert sfs._hdr.chunk_size == chunk_size
+        assert sfs.read_file(sfs.find_file('big.bin')) == big
+        f = sfs.find_file('dir/small.txt')
+        assert sfs.read_file(f, b'lol') == b'hello'
+        sfs.write_file(f, b'world' * 100, b'lol')
+        assert sfs.read_file(sfs.find_file('dir/small.txt'),
+                             b'lol') == b'world' * 100
+        assert sfs.verify(b'lol', decode=True, workers=1).ok
+    os.unlink(pat1)
+
+    with pytest.raises(NotImplementedError):
+        SFSBuilder(3000)
+
+
+def test_sfs_replace_file_differential() -> None:
+    pat1 = asset('differential_example.sfs')
+    data = bytearray(bytes(range(256)) * 1000)
+    builder = SFSBuilder()
+    builder.add_file('big.bin', bytes(data), b'lol', None)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+
+    data[100000:100004] = b'edit'
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        f = sfs.find_file('big.bin')
+        stats = sfs.enable_stats()
+        sfs.write_file(f, bytes(data), b'lol', None, differential=True)
+        # only the data chunk holding the edit is written, not the tree
+        assert stats.snapshot()['put_chunk']['calls'] == 1
+        assert sfs.read_file(sfs.find_file('big.bin'), b'lol') == data
+    os.unlink(pat1)
+
+
+def test_sfs_sync(tmp_path: str) -> None:
+    src = os.path.join(tmp_path, 'src')
+    files = {
+        'a.txt': b'first',
+        'd/b.txt': b'second',
+        'd/e/c.bin': bytes(range(256)) * 40,
+        'gone.txt': b'',
+    }
+    for path, data in files.items():
+        full = os.path.join(src, *path.split('/'))
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as fd:
+            fd.write(data)
+    pat1 = os.path.join(tmp_path, 'synced.sfs')
+    with open(pat1, 'wb') as fd:
+        SFSBuilder().write(fd)
+
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        result = sfs.sync(src, b'lol')
+        assert sorted(result.added) == sorted([*files, 'd', 'd/e'])
+        stats = sfs.enable_stats()
+        assert not sfs.sync(src, b'lol').changed
+        assert 'put_chunk' not in stats.snapshot()
+
+        with open(os.path.join(src, 'a.txt'), 'wb') as out:
+            out.write(b'changed')
+        os.utime(os.path.join(src, 'a.txt'), (1e9, 1e9))
+        os.utime(os.path.join(src, 'd', 'b.txt'), (1e9, 1e9))
+        os.unlink(os.path.join(src, 'd', 'e', 'c.bin'))
+        os.rmdir(os.path.join(src, 'd', 'e'))
+        result = sfs.sync(src, b'lol', checksum=True)
+        assert result.replaced == ['a.txt']
+        assert result.touched == ['d/b.txt']
+        assert sorted(result.deleted) == ['d/e', 'd/e/c.bin']
+        assert result.unchanged == 2
+
+        contents = {path: sfs.read_file(f, b'lol' if f.encrypted else None)
+                    for path, f in sfs.walk()}
+        assert contents == {'a.txt': b'changed', 'd': b'',
+                            'd/b.txt': b'second', 'gone.txt': b''}
+        report = sfs.verify(b'lol', decode=True, workers=1)
+        assert report.ok and not report.leaked
+
+
+def test_sfs_sync_abort(tmp_path: str) -> None:
+    src = os.path.join(tmp_path, 'src')
+    os.makedirs(src)
+    a, b = os.path.join(src, 'a.txt'), os.path.join(src, 'b.txt')
+    with open(a, 'wb') as fd:
+        fd.write(b'plain ' * 1000)
+    pat1 = os.path.join(tmp_path, 'abort.sfs')
+    with open(pat1, 'wb') as fd:
+        SFSBuilder().write(fd)
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        sfs.sync(src)
+        with open(b, 'wb') as fd2:
+            fd2.write(b'secret')
+        sfs.sync(src, b'lol')
+        for path in (a, b):
+            with open(path, 'ab') as fd2:
+                fd2.write(b'!')
+        # a.txt is replaced first, then b.txt needs the password
+        with pytest.raises(ValueError):
+            sfs.sync(src)
+        used = sfs._get_data_chunk_indexes(sfs.find_file('a.txt'))
+        assert not set(used) & sfs._empty_chunks
+        sfs.copy_member(sfs, 'a.txt')
+        result = sfs.sync(src, b'lol')
+        assert sorted(result.replaced) == ['a.txt', 'b.txt']
+        report = sfs.verify(b'lol', decode=True, workers=1)
+        assert report.ok and not report.leaked
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sfs_read_many(workers: int) -> None:
+    path = asset('directory_example.sfs')
+    with open(path, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        expected = {p: sfs.read_file(f, b'lol') for p, f in sfs.walk()}
+        result = dict(sfs.read_many(expected, b'lol', workers))
+        assert result == expected
+        with pytest.raises(FileNotFoundError):
+            list(sfs.read_many(['small.txt', 'missing.txt'], b'lol'))
+
+
+def test_sfs_read_many_small(monkeypatch: pytest.MonkeyPatch) -> None:
+    # a few small members are decoded without starting a process pool
+    monkeypatch.setattr('sfs.sfs.ProcessPoolExecutor', None)
+    with open(asset('directory_example.sfs'), 'rb') as fd:
+        sfs = SFSContainer(fd)
+        expected = {p: sfs.read_file(f, b'lol') for p, f in sfs.walk()}
+        assert dict(sfs.read_many(expected, b'lol')) == expected
+
+
+def test_sfs_archive_encryption(tmp_path: str) -> None:
+    pat1 = os.path.join(tmp_path, 'whole.sfs')
+    text = b'plain text member ' * 300
+    builder = SFSBuilder(archive_password=b'lol')
+    builder.add_file('dir/text.txt', text, None, None)
+    builder.add_file('secret.txt', b'secret', b'lol')
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+    with open(pat1, 'rb') as fd:
+        raw = fd.read()
+    assert b'text.txt' not in raw and b'plain text' not in raw
+
+    with open(pat1, 'rb+') as fd:
+        with pytest.raises(ValueError):
+            SFSContainer(fd)
+        fd.seek(0)
+        sfs = SFSContainer(fd, b'lol')
+        contents = dict(sfs.read_many(['dir/text.txt', 'secret.txt'],
+                                      b'lol', workers=2))
+        assert contents == {'dir/text.txt': text, 'secret.txt': b'secret'}
+        f = sfs.find_file('dir/text.txt')
+        sfs.write_file(f, text.upper(), None, None)
+        assert sfs.verify(b'lol', decode=True, workers=1).ok
+        assert not sfs.verify().ok
+
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd, b'lol')
+        assert sfs.read_file(sfs.find_file('dir/text.txt')) == text.upper()
+
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd, b'lol')
+        with pytest.raises(ValueError):
+            sfs.rekey(b'WRONG', b'new')
+        sfs.rekey(b'lol', b'new')
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd, b'new')
+        assert sfs.read_file(sfs.find_file('dir/text.txt')) == text.upper()
+        assert sfs.read_file(sfs.find_file('secret.txt'), b'new') == b'secret'
+        assert sfs.verify(b'new', decode=True, workers=1).ok
+
+
+def fail_commit(entries: list[FileHeader]) -> None:
+    raise OSError('disk full')
+
+
+def test_sfs_concurrent_update(tmp_path: str,
+                               monkeypatch: pytest.MonkeyPatch) -> None:
+    pat1 = os.path.join(tmp_path, 'concurrent.sfs')
+    builder = SFSBuilder()
+    for i in range(12):
+        builder.add_file(f'file{i}.bin', bytes([i]) * 5000, b'lol')
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+
+    updates = [(f'file{i}.bin', bytes([i + 100]) * (3000 + 4000 * (i % 3)))
+               for i in range(12)]
+    updates.append(('file0.bin', b'again'))
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(
+                lambda u: sfs.update_file(u[0], u[1], b'lol'), updates))
+        expected = dict(updates[1:])
+        expected['file0.bin'] = sfs.read_file(sfs.find_file('file0.bin'),
+                                              b'lol')
+        assert expected['file0.bin'] in (b'again', updates[0][1])
+        for path, f in sfs.walk():
+            assert sfs.read_file(f, b'lol') == expected[path]
+        report = sfs.verify(b'lol', decode=True, workers=1)
+        assert report.ok and not report.leaked
+
+        # a failed commit keeps the old member and gives back the new chunks
+        live = set(sfs._get_data_chunk_indexes(sfs.find_file('file1.bin')))
+        empty = set(sfs._empty_chunks)
+        monkeypatch.setattr(sfs, '_put_entries', fail_commit)
+        with pytest.raises(OSError):
+            sfs.update_file('file1.bin', b'lost' * 3000, b'lol')
+        monkeypatch.undo()
+        assert not sfs._commit_errors and not sfs._batch_waiters
+        assert not live & sfs._empty_chunks
+        assert empty <= sfs._empty_chunks
+        assert sfs.read_file(sfs.find_file('file1.bin'),
+                             b'lol') == expected['file1.bin']
+        report = sfs.verify(b'lol', decode=True, workers=1)
+        assert report.ok and not report.leaked
+
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'),
+                    reason='needs posix_fadvise')
+def test_sfs_prefetch(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    pat1 = os.path.join(tmp_path, 'prefetch.sfs')
+    data = bytes(range(256)) * 100
+    builder = SFSBuilder()
+    builder.add_file('big.bin', data, b'lol', None)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+
+    advised: list[int] = []
+    monkeypatch.setattr(os, 'posix_fadvise',
+                        lambda fd, offset, length, advice:
+                        advised.append(offset))
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        f = sfs.find_file('big.bin')
+        offsets = [sfs._hdr.chunk_position(c)
+                   for c in sfs._get_data_chunk_indexes(f)]
+        sfs.prefetch_depth = 3
+        assert sfs.read_file(f, b'lol') == data
+        assert advised == offsets
+        advised.clear()
+        sfs.prefetch_depth = 0
+        assert sfs.read_file(f, b'lol') == data
+        assert advised == []
+
+
+def test_sfs_lazy_headers() -> None:
+    with open(asset('directory_example.sfs'), 'rb') as fd:
+        sfs = SFSContainer(fd)
+        chunk_idx, dt = next(sfs.enumerate_tree())
+        chunk = sfs._get_chunk(chunk_idx)
+    f = dt.files[1]
+    assert f._fields is None
+    assert (f.filename, f.ftype) == ('directory', 16)
+    assert f.serialize() == chunk[32 + 512:32 + 1024]
+    assert dt.serialize(len(chunk)) == chunk
+    copy = pickle.loads(pickle.dumps(f))
+    assert copy == f and copy.serialize() == f.serialize()
+    f.size = 1234
+    assert f._fields is not None
+    assert (f.filename, f.size) == ('directory', 1234)
+    assert FileHeader(f.serialize()) == f
+
+
+def test_sfs_entry_paths() -> None:
+    with open(asset('directory_example.sfs'), 'rb') as fd:
+        sfs = SFSContainer(fd)
+        entries = sfs.get_entries()
+        paths = entry_paths(entries)
+        assert paths == [p for p, _ in sfs.walk()]
+    assert paths[5] == 'directory/subdirectory'
+    # a loop in the parents ends the path instead of hanging
+    entries[1].parent = 5
+    assert entry_paths(entries)[3] == 'subdirectory/directory/LayoutDef.lyd'
+
+
+def test_sfs_clone(tmp_path: str) -> None:
+    pat1 = os.path.join(tmp_path, 'ugly_label_clone.stc')
+    with open(asset('LayoutDef.lyd'), 'rb') as src:
+        layout = src.read()
+    with open(asset('ugly_label.stc'), 'rb') as fd:
+        original = fd.read()
+        fd.seek(0)
+        sfs = SFSContainer(fd)
+        sfs._refresh_empty_chunks()
+        clone = sfs.clone(pat1)
+        assert clone._empty_chunks == sfs._empty_chunks
+        f = clone.find_file('LayoutDef.lyd')
+        clone.write_file(f, layout, b'45654hKL5-GFD1326lvmaQQ')
+        clone.fd.close()
+        fd.seek(0)
+        assert fd.read() == original
+    with open(pat1, 'rb') as fd:
+        d = hashlib.md5(fd.read(), usedforsecurity=False).digest()
+    assert d.hex() == 'b840b291e02e4b677582a19f0971ef20'
+
+    pat2 = os.path.join(tmp_path, 'whole.sfs')
+    builder = SFSBuilder(archive_password=b'lol')
+    builder.add_file('text.txt', b'text', None, None)
+    with open(pat2, 'wb') as fd:
+        builder.write(fd, workers=1)
+    sfs = open_archive(pat2, password=b'lol')
+    clone = sfs.clone(os.path.join(tmp_path, 'whole_clone.sfs'))
+    assert clone._index is not None
+    assert clone.read_file(clone.find_file('text.txt')) == b'text'
+    assert clone.verify(b'lol').ok
+    clone.fd.close()
+    sfs.fd.close()
+
+
+def test_sfs_read_range_checkpoints(tmp_path: str) -> None:
+    pat1 = os.path.join(tmp_path, 'ranges.sfs')
+    data = b''.join(b'%08d\n' % i for i in range(40000))
+    builder = SFSBuilder()
+    builder.add_file('deflated.txt', data, b'lol')
+    builder.add_file('stored.txt', data, None, 0)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+    ranges = [(0, 4), (123456, 130000), (len(data) - 3, len(data) + 9)]
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        sfs.inflate_span = 0x4000
+        f = sfs.find_file('deflated.txt')
+        assert sfs.read_range(f, 5, 9, b'lol') == data[5:9]
+        assert f.offset in sfs._inflate_indexes
+        for start, end in ranges:
+            assert sfs.read_range(f, start, end, b'lol') == data[start:end]
+            stored = sfs.find_file('stored.txt')
+            assert sfs.read_range(stored, start, end) == data[start:end]
+        sfs._inflate_indexes.clear()
+        sfs.write_file(f, data, b'lol')
+        assert f.offset in sfs._inflate_indexes
+        assert sfs.read_range(f, 100, 200, b'lol') == data[100:200]
+
+
+def test_sfs_edit_metadata(tmp_path: str) -> None:
+    pat1 = os.path.join(tmp_path, 'edit.sfs')
+    with open(asset('directory_example.sfs'), 'rb') as src:
+        with open(pat1, 'wb') as dst:
+            dst.write(src.read())
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        stats = sfs.enable_stats()
+        with sfs.edit_metadata() as batch:
+            batch.rename('small.txt', 'big.txt')
+            batch.move('photo.jpg', 'directory/subdirectory')
+            batch.rename('directory', 'folder')
+            batch.set_times('emptydir', written=133802050.0)
+        assert stats.snapshot()['put_chunk']['calls'] == 1
+
+        batch = sfs.edit_metadata()
+        batch.move('directory', 'directory/subdirectory')
+        with pytest.raises(FileNotFoundError):
+            batch.commit()
+        batch = sfs.edit_metadata()
+        batch.move('folder', 'folder/subdirectory')
+        with pytest.raises(ValueError):
+            batch.commit()
+        batch = sfs.edit_metadata()
+        batch.rename('big.txt', 'emptydir')
+        with pytest.raises(FileExistsError):
+            batch.commit()
+        assert stats.snapshot()['put_chunk']['calls'] == 1
+        assert sfs.verify(b'lol', decode=True, workers=1).ok
+
+    with open(pat1, 'rb') as fd:
+        files = dict(SFSContainer(fd).walk())
+    assert sorted(files) == [
+        'big.txt', 'emptydir', 'folder', 'folder/LayoutDef.lyd',
+        'folder/ce.png', 'folder/subdirectory',
+        'folder/subdirectory/Screenshot 2024-09-23 102849.png',
+        'folder/subdirectory/photo.jpg']
+    assert files['emptydir'].times[2] == 133802050.0
+
+
+def test_sfs_probe_password() -> None:
+    candidates = [b'wrong', b'lol', b'45654hKL5-GFD1326lvmaQQ']
+    with open(asset('encrypted_example.sfs'), 'rb') as fd:
+        sfs = SFSContainer(fd)
+        assert sfs.probe_password(candidates, workers=1) == b'lol'
+        assert sfs.probe_password(candidates, workers=2) == b'lol'
+        assert sfs.probe_password([b'wrong', b'also wrong']) is None
+    with open(asset('ugly_label.stc'), 'rb') as fd:
+        sfs = SFSContainer(fd)
+        assert sfs.probe_password(candidates) == candidates[2]
+
+
+def test_sfs_probe_password_unpadded(tmp_path: str) -> None:
+    # a stored member filling its only chunk has no padding to check
+    pat1 = os.path.join(tmp_path, 'unpadded.sfs')
+    builder = SFSBuilder()
+    builder.add_file('full.bin', (bytes(range(256)) * 16)[:4064],
+                     b'right', None)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+    with open(pat1, 'rb+') as fd:
+        sfs = SFSContainer(fd)
+        with pytest.raises(ValueError):
+            sfs.probe_password([b'wrong', b'right'])
+        with pytest.raises(ValueError):
+            sfs.rekey(b'wrong', b'new')
+
+    builder.add_file('padded.bin', bytes(range(100)), b'right', None)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+    with open(pat1, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        assert sfs.probe_password([b'wrong', b'right']) == b'right'
+
+
+def test_sfs_stats() -> None:
+    path = asset('ugly_label.stc')
+    events: list[str] = []
+    with open(path, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        stats = sfs.enable_stats(lambda stage, t, n: events.append(stage))
+        f = sfs.find_file('Devices.def')
+        assert stats.snapshot()['get_chunk']['calls'] == 2
+        stats.reset()
+        events.clear()
+        sfs.read_file(f, b'45654hKL5-GFD1326lvmaQQ')
+        snapshot = stats.snapshot()
+        assert snapshot['get_chunk']['calls'] == 2
+        assert snapshot['get_chunk']['bytes'] == 2 * 4096
+        assert snapshot['explode_key']['calls'] == 2
+        assert snapshot['sfs_decrypt']['bytes'] == 32 + 4064
+        for stage in ['checkxor', 'aacs_inflate', 'crc16']:
+            assert snapshot[stage]['calls'] == 1
+        assert sorted(events) == sorted(
+            stage for stage, s in snapshot.items()
+            for _ in range(int(s['calls'])))
+
+        stats.reset()
+        sfs.disable_stats()
+        sfs.read_file(f, b'45654hKL5-GFD1326lvmaQQ')
+        assert stats.snapshot() == {}
+
+
+def test_sfs_verify() -> None:
+    pat0 = asset('directory_example.sfs')
+    pat1 = asset('directory_example_verify.sfs')
+    with open(pat0, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        report = sfs.verify(b'lol', decode=True, workers=2)
+        assert report.ok, report
+        assert report.n_entries == 8
+        assert report.members_checked == 5
+        assert report.leaked == []
+
+    with open(pat0, 'rb') as src:
+        data = bytearray(src.read())
+    # flip a byte in the data of small.txt, chunk 6
+    data[280 + 6 * 4096 + 100] ^= 1
+    # point the index of ce.png, chunk 13, at a chunk of photo.jpg
+    data[280 + 13 * 4096 + 32:280 + 13 * 4096 + 36] = b'\x08\x00\x00\x00'
+    with open(pat1, 'wb') as dst:
+        dst.write(data)
+    with open(pat1, 'rb') as fd:
+        report = SFSContainer(fd).verify(b'lol', decode=True, workers=1)
+    assert not report.ok
+    assert report.bad_xor == [6]
+    assert report.cross_linked == [8]
+    assert report.leaked == [14]
+    assert set(report.bad_members) == {'small.txt'}
+    os.unlink(pat1)
+
+
+def test_sfs_verify_corrupt_stream(tmp_path: str) -> None:
+    pat1 = os.path.join(tmp_path, 'corrupt.sfs')
+    builder = SFSBuilder()
+    builder.add_file('text.txt', b'some text ' * 100, None, 6)
+    with open(pat1, 'wb') as fd:
+        builder.write(fd, workers=1)
+    with open(pat1, 'rb') as fd:
+        data = bytearray(fd.read())
+    # break the zlib header of the only data chunk, 6, keeping its xor
+    body = 280 + 6 * 4096 + 32
+    data[body + 0x90] ^= 0xff
+    xor = checkxor(bytes(data[body:body + 4064]))
+    data[body - 28:body - 24] = xor.to_bytes(4, 'little')
+    with open(pat1, 'wb') as fd:
+        fd.write(data)
+    with open(pat1, 'rb') as fd:
+        report = SFSContainer(fd).verify(decode=True, workers=1)
+    assert report.bad_xor == []
+    assert set(report.bad_members) == {'text.txt'}
+    assert 'error' in report.bad_members['text.txt']
+    # the batch goes on past the broken archive
+    assert main(['-q', 'cat', 'text.txt', pat1, pat1]) == 1
+    assert main(['-q', 'verify', pat1]) == 1
@@ -0,0 +1,50 @@
+import os.path
+
+from sfs import SFSContainer
+from sfs.cache import (CacheStats, LRUCache, disable_member_cache,
+                       enable_member_cache)
+
+
+def asset(filename: str) -> str:
+    return os.path.join(*os.path.split(__file__)[:-1], 'assets', filename)
+
+
+def test_lru_cache() -> None:
+    cache = LRUCache[str](10)
+    cache.put('a', b'1234')
+    cache.put('b', b'5678')
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'90ab')
+    cache.put('huge', b'x' * 11)
+    assert cache.get('b') is None and cache.get('huge') is None
+    assert cache.get('c') == b'90ab'
+    assert cache.stats() == CacheStats(hits=2, misses=2, evictions=1,
+                                       entries=2, bytes=8)
+    cache.clear()
+    assert cache.stats() == CacheStats()
+
+
+def test_member_cache() -> None:
+    cache = enable_member_cache(1 << 20)
+    try:
+        with open(asset('encrypted_example.sfs'), 'rb') as fd:
+            sfs = SFSContainer(fd)
+            stats = sfs.enable_stats()
+            f = sfs.find_file('photo.jpg')
+            data = sfs.read_file(f, b'lol')
+            assert sfs.read_file(f, b'lol') == data
+            assert stats.snapshot()['explode_key']['calls'] == 2
+            assert dict(sfs.read_many(['photo.jpg'], b'lol')) == {
+                'photo.jpg': data}
+            assert cache.stats().hits == 2
+            try:
+                sfs.read_file(f, b'wrong')
+            except (AssertionError, ValueError):
+                pass
+            assert cache.stats().hits == 2
+        with open(asset('directory_example.sfs'), 'rb') as fd:
+            sfs = SFSContainer(fd)
+            assert sfs.read_file(sfs.find_file('photo.jpg'), b'lol') == data
+            assert cache.stats().hits == 3
+    finally:
+        disable_member_cache()
@@ -0,0 +1,41 @@
+import os.path
+import shutil
+
+import pytest
+
+from sfs import SFSBuilder
+from sfs.catalog import scan
+
+
+def asset(filename: str) -> str:
+    return os.path.join(*os.path.split(__file__)[:-1], 'assets', filename)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_scan(tmp_path: str, workers: int) -> None:
+    sub = os.path.join(tmp_path, 'sub')
+    os.makedirs(sub)
+    shutil.copy(asset('ugly_label.stc'), tmp_path)
+    shutil.copy(asset('directory_example.sfs'), sub)
+    with open(os.path.join(sub, 'broken.stc'), 'wb') as fd:
+        fd.write(b'not an archive')
+    builder = SFSBuilder()
+    builder.add_file('big.bin', bytes(range(256)) * 100, None, None)
+    builder.add_directory('empty')
+    with open(os.path.join(sub, 'built.sfs'), 'wb') as fd:
+        builder.write(fd, workers=1)
+
+    records = list(scan(str(tmp_path), workers=workers))
+    by_archive: dict[str, list[str]] = {}
+    for r in records:
+        by_archive.setdefault(os.path.basename(r.archive), []).append(r.path)
+    assert sorted(by_archive) == ['broken.stc', 'built.sfs',
+                                  'directory_example.sfs', 'ugly_label.stc']
+    assert 'directory/LayoutDef.lyd' in by_archive['directory_example.sfs']
+
+    broken, = [r for r in records if r.archive.endswith('broken.stc')]
+    assert broken.error is not None
+    big, = [r for r in records if r.path == 'big.bin']
+    assert (big.size, big.chunks, big.fragments) == (25600, 7, 1)
+    empty, = [r for r in records if r.path == 'empty']
+    assert (empty.ftype, empty.chunks, empty.fragments) == (16, 0, 0)
@@ -0,0 +1,68 @@
+import os.path
+import shutil
+
+import pytest
+
+from sfs import SFSBuilder
+from sfs.cli import main
+
+
+def asset(filename: str) -> str:
+    return os.path.join(*os.path.split(__file__)[:-1], 'assets', filename)
+
+
+def test_cli_ls_verify(capsys: pytest.CaptureFixture[str],
+                       monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('SFS_PASSWORD', 'lol')
+    archives = [asset('directory_example.sfs'),
+                asset('compressed_example.sfs')]
+    assert main(['-j', '2', '-q', 'ls', *archives]) == 0
+    out = capsys.readouterr().out
+    assert 'e      13791 photo.jpg' in out
+    assert 'd          0 directory/subdirectory' in out
+    assert main(['-q', 'verify', *archives]) == 0
+    assert capsys.readouterr().out.count(': OK') == 2
+
+
+def test_cli_extract_pack(tmp_path: str,
+                          capsysbinary: pytest.CaptureFixture[bytes]) -> None:
+    password = os.path.join(tmp_path, 'password')
+    with open(password, 'w') as fd:
+        fd.write('lol\n')
+    archive = os.path.join(tmp_path, 'example.sfs')
+    shutil.copy(asset('directory_example.sfs'), archive)
+    opts = ['-q', '--password-file', password]
+    assert main([*opts, 'extract', '-o', str(tmp_path), archive]) == 0
+    extracted = os.path.join(tmp_path, 'example')
+    path = os.path.join(extracted, 'directory', 'LayoutDef.lyd')
+    with open(path, 'rb') as fd, open(asset('LayoutDef.lyd'), 'rb') as fd2:
+        assert fd.read() == fd2.read()
+
+    os.unlink(archive)
+    assert main([*opts, 'pack', extracted]) == 0
+    capsysbinary.readouterr()
+    assert main([*opts, 'cat', 'directory/LayoutDef.lyd', archive]) == 0
+    with open(asset('LayoutDef.lyd'), 'rb') as fd:
+        assert capsysbinary.readouterr().out == fd.read()
+
+
+def test_cli_extract_unsafe(tmp_path: str,
+                            capsys: pytest.CaptureFixture[str]) -> None:
+    archive = os.path.join(tmp_path, 'evil.sfs')
+    builder = SFSBuilder()
+    builder.add_file('../../evil.txt', b'evil', None, None)
+    builder.add_file('good.txt', b'good', None, None)
+    with open(archive, 'wb') as fd:
+        builder.write(fd, workers=1)
+    outdir = os.path.join(tmp_path, 'out', 'deep')
+    assert main(['-q', 'extract', '-o', outdir, archive]) == 1
+    assert "unsafe member name '../../evil.txt'" in capsys.readouterr().out
+    assert os.listdir(os.path.join(outdir, 'evil')) == ['good.txt']
+    assert not os.path.exists(os.path.join(tmp_path, 'out', 'evil.txt'))
+    assert not os.path.exists(os.path.join(tmp_path, 'evil.txt'))
+
+
+def test_cli_error(capsys: pytest.CaptureFixture[str]) -> None:
+    assert main(['-q', 'cat', 'missing.txt',
+                 asset('compressed_example.sfs')]) == 1
+    assert 'FileNotFoundError' in capsys.readouterr().out
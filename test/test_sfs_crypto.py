@@ -1,4 +1,7 @@
-from sfs.wrongaes import WrongAES, expand_key_32B, explode_key, spiceup
+import pytest
+
+from sfs.wrongaes import (WrongAES, expand_key_32B, explode_key, spiceup,
+                          crc16, crc16_combine, sfs_encrypt)
 
 
 def test_key_spicing() -> None:
@@ -90,6 +93,25 @@ def test_AES_encrypt_decrypt() -> None:
     assert pt2 == pt
 
 
+def test_crc16_combine() -> None:
+    a = b'123456789' * 100
+    b = bytes(range(256)) * 3
+    assert crc16_combine(crc16(a), crc16(b), len(b)) == crc16(a + b)
+    assert crc16_combine(crc16(a), crc16(b''), 0) == crc16(a)
+
+
+def test_sfs_encrypt_chunks() -> None:
+    npaes = pytest.importorskip('sfs.npaes')
+    key = explode_key(b'45654hKL5-GFD1326lvmaQQ')
+    chunks = [bytes([i]) * 4064 for i in range(5)]
+    expected = []
+    for chunk in chunks:
+        data = bytearray(chunk)
+        sfs_encrypt(data, key)
+        expected.append(bytes(data))
+    assert npaes.sfs_encrypt_chunks(chunks, key) == expected
+
+
 if __name__ == '__main__':
     test_expand_key()
     test_AES_decrypt()
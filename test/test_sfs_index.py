@@ -0,0 +1,59 @@
+import os.path
+
+from sfs import SFSContainer
+from sfs.index import (ArchiveIndex, INDEX_SUFFIX, build_index, clear_cache,
+                       open_archive)
+
+
+def asset(filename: str) -> str:
+    return os.path.join(*os.path.split(__file__)[:-1], 'assets', filename)
+
+
+def test_index_roundtrip() -> None:
+    with open(asset('directory_example.sfs'), 'rb') as fd:
+        index = build_index(SFSContainer(fd))
+    parsed = ArchiveIndex.parse(index.serialize())
+    assert parsed == index
+    assert parsed.free == set(range(26, 33))
+
+
+def test_open_archive() -> None:
+    pat0 = asset('directory_example.sfs')
+    pat1 = asset('directory_example_index.sfs')
+    with open(pat0, 'rb') as src:
+        with open(pat1, 'wb') as dst:
+            dst.write(src.read())
+
+    with open(pat0, 'rb') as fd:
+        sfs = SFSContainer(fd)
+        expected = [(path, sfs.read_file(f, b'lol'))
+                    for path, f in sfs.walk()]
+
+    clear_cache()
+    sfs = open_archive(pat1)
+    assert os.path.exists(pat1 + INDEX_SUFFIX)
+    sfs.fd.close()
+
+    # the sidecar is used without walking the archive again
+    clear_cache()
+    sfs = open_archive(pat1)
+    assert sfs._index is not None
+    sfs._get_chunk = None  # type: ignore
+    entries = list(sfs.walk())
+    del sfs._get_chunk
+    assert [(p, sfs.read_file(f, b'lol')) for p, f in entries] == expected
+    sfs.fd.close()
+
+    # writing drops the index, reopening notices the change
+    with open(pat0, 'rb') as fd:
+        sfs = open_archive(pat1, writable=True)
+        sfs.copy_member(SFSContainer(fd), 'small.txt')
+        assert sfs._index is None
+        sfs.fd.close()
+    sfs = open_archive(pat1)
+    assert sfs._index is not None
+    assert sfs._index.free == {5, 6, *range(28, 33)}
+    sfs.fd.close()
+
+    os.unlink(pat1)
+    os.unlink(pat1 + INDEX_SUFFIX)
@@ -0,0 +1,47 @@
+import os.path
+import zlib
+
+import pytest
+
+from sfs.inflate import aacs_inflate_indexed, inflate_indexed, inflate_range
+from sfs.utils import aacs_deflate
+
+
+def asset(filename: str) -> str:
+    return os.path.join(*os.path.split(__file__)[:-1], 'assets', filename)
+
+
+def test_inflate_range() -> None:
+    with open(asset('LayoutDef.lyd'), 'rb') as fd:
+        data = fd.read() * 8
+    deflated = zlib.compress(data, 6)
+    inflated, index = inflate_indexed(deflated, 0x1000)
+    assert inflated == data and index.size == len(data)
+    assert len(index.checkpoints) == -(-len(data) // 0x1000)
+    assert [cp.out_offset for cp in index.checkpoints[:3]] == [0, 0x1000,
+                                                               0x2000]
+
+    reads = []
+
+    def read(offset: int, n: int) -> bytes:
+        reads.append(offset)
+        return deflated[offset:offset + n]
+
+    for start, end in [(0, 10), (0x1000, 0x1001), (0x2fff, 0x3003),
+                       (len(data) - 5, len(data) + 100), (7, 7)]:
+        reads.clear()
+        assert inflate_range(index, read, start, end) == data[start:end]
+        if start > 0x1000:
+            assert min(reads) > 0
+
+    with pytest.raises(ValueError):
+        inflate_range(index, lambda offset, n: b'', 0, len(data))
+
+
+def test_aacs_inflate_indexed() -> None:
+    data = bytes(range(256)) * 1000
+    inflated, index = aacs_inflate_indexed(aacs_deflate(data, 1), 0x8000)
+    assert inflated == data and index is not None
+    assert aacs_inflate_indexed(aacs_deflate(data, 0), 0x8000) == (data, None)
+    with pytest.raises(AssertionError):
+        aacs_inflate_indexed(aacs_deflate(data, 1)[:-10], 0x8000)
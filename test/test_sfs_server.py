@@ -0,0 +1,80 @@
+import os.path
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from sfs import SFSBuilder, SFSContainer
+from sfs.server import MemberServer, parse_range
+
+
+def test_parse_range() -> None:
+    assert parse_range('bytes=0-9', 100) == (0, 10)
+    assert parse_range('bytes=90-', 100) == (90, 100)
+    assert parse_range('bytes=-5', 100) == (95, 100)
+    assert parse_range('bytes=50-500', 100) == (50, 100)
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    with pytest.raises(ValueError):
+        parse_range('bytes=100-', 100)
+
+
+def test_server(tmp_path: str) -> None:
+    stored = bytes(range(256)) * 64
+    text = b'compressed member\n' * 100
+    builder = SFSBuilder()
+    builder.add_file('dir/stored.bin', stored, b'lol', None)
+    builder.add_file('text.txt', text)
+    builder.add_file('other.txt', text, b'other')
+    os.makedirs(os.path.join(tmp_path, 'labels'))
+    with open(os.path.join(tmp_path, 'labels', 'a.stc'), 'wb') as fd:
+        builder.write(fd, workers=1)
+
+    server = MemberServer(('127.0.0.1', 0), str(tmp_path), b'lol')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f'http://127.0.0.1:{server.server_address[1]}/labels/a.stc/'
+
+    def get(member: str, **headers: str) -> tuple[int, dict[str, str],
+                                                  bytes]:
+        req = urllib.request.Request(base + member, headers=headers)
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return resp.status, dict(resp.headers), resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), b''
+
+    try:
+        status, headers, body = get('text.txt')
+        assert status == 200 and body == text
+        assert headers['Content-Type'] == 'text/plain'
+        assert get('text.txt', Range='bytes=18-35')[2] == text[18:36]
+        assert get('text.txt', **{'If-None-Match': headers['ETag']}
+                   )[0] == 304
+
+        status, headers, body = get('dir/stored.bin', Range='bytes=5000-9999')
+        assert status == 206 and body == stored[5000:10000]
+        assert headers['Content-Range'] == f'bytes 5000-9999/{len(stored)}'
+        assert get('dir/stored.bin', Range='bytes=-10')[2] == stored[-10:]
+        assert get('dir/stored.bin', Range='bytes=99999-')[0] == 416
+        assert get('dir/stored.bin')[2] == stored
+
+        assert get('missing.txt')[0] == 404
+        assert get('dir')[0] == 404
+        # encrypted with another password, the stream does not inflate
+        assert get('other.txt')[0] == 500
+        assert os.listdir(os.path.join(tmp_path, 'labels')) == ['a.stc']
+
+        # a member rewritten in place with the same size is not served stale
+        tag = get('text.txt')[1]['ETag']
+        time.sleep(0.05)
+        with open(os.path.join(tmp_path, 'labels', 'a.stc'), 'rb+') as fd2:
+            sfs = SFSContainer(fd2)
+            sfs.write_file(sfs.find_file('text.txt'), text.upper())
+        status, headers, body = get('text.txt', **{'If-None-Match': tag})
+        assert status == 200 and body == text.upper()
+        assert headers['ETag'] != tag
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,55 @@
+import os.path
+import zlib
+
+import pytest
+
+from sfs.utils import (aacs_deflate, aacs_deflate_parallel, aacs_inflate,
+                       choose_compression_level, plausible_prefix)
+
+
+def asset(filename: str) -> str:
+    return os.path.join(*os.path.split(__file__)[:-1], 'assets', filename)
+
+
+def test_aacs_all_levels() -> None:
+    with open(asset('LayoutDef.lyd'), 'rb') as fd:
+        data = fd.read()
+    for level in range(10):
+        deflated = aacs_deflate(data, level)
+        assert deflated[20] == level
+        assert aacs_inflate(deflated) == data
+    assert len(aacs_deflate(data, 0)) == len(data) + 0x90
+
+
+def test_aacs_invalid_level() -> None:
+    with pytest.raises(ValueError):
+        aacs_deflate(b'hello', 10)
+
+
+def test_choose_compression_level() -> None:
+    with open(asset('LayoutDef.lyd'), 'rb') as fd:
+        layout = fd.read()
+    assert choose_compression_level(layout, 6) == 6
+    assert choose_compression_level(b'\x89PNG\r\n\x1a\n' + layout, 6) == 0
+    assert choose_compression_level(zlib.compress(layout * 20), 6) == 0
+    assert choose_compression_level(b'', 6) == 6
+
+
+def test_aacs_deflate_parallel() -> None:
+    with open(asset('LayoutDef.lyd'), 'rb') as fd:
+        data = fd.read() * 4
+    for level in [0, 1, 6, 9]:
+        deflated = aacs_deflate_parallel(data, level, workers=2,
+                                         block_size=0x8000)
+        assert aacs_inflate(deflated) == data
+        serial = aacs_deflate(data, level)
+        assert deflated[0x88:0x8c] == serial[0x88:0x8c]
+
+
+def test_plausible_prefix() -> None:
+    assert plausible_prefix(aacs_deflate(b'x' * 100, 6)[:32], 200)
+    assert plausible_prefix(b'hello' + b'\x00' * 27, 5)
+    assert not plausible_prefix(b'hello' + b'\x01' * 27, 5)
+    assert plausible_prefix(b'\xff\xd8\xff\xe0' + bytes(range(28)), 4000)
+    assert plausible_prefix('[Layout]\r\nname=é'.encode() * 2, 4000)
+    assert not plausible_prefix(bytes(range(200, 232)), 4000)